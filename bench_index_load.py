@@ -0,0 +1,103 @@
+# bench_index_load.py — время загрузки и память: FAISS-индекс в heap vs mmap, float16-матрица
+#
+# Каждый режим меряется в отдельном свежем процессе (--repeat раз, медиана):
+#   heap   — faiss.read_index без флагов (как было)
+#   mmap   — faiss_search.read_index с IO_FLAG_MMAP_IFC / IO_FLAG_MMAP
+#   f16    — np.load(faiss_embeddings.f16.npy, mmap_mode="r") + get_vectors
+# RSS и Anonymous из /proc/self/smaps_rollup: anon — приватная память процесса,
+# file-backed страницы mmap делятся между воркерами через page cache.
+# Замер после загрузки и после первого поиска / чтения всех векторов
+# (страницы mmap подтягиваются при первом обращении).
+#
+#   python bench_index_load.py --repeat 5 [--json]
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+MODES = ("heap", "mmap", "f16")
+
+def _mem_kb() -> dict[str, int]:
+    mem = {}
+    for line in Path("/proc/self/smaps_rollup").read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key in ("Rss", "Anonymous"):
+            mem[key.lower()] = int(value.split()[0])
+    return mem
+
+def _delta(after: dict, before: dict) -> dict:
+    return {k: after[k] - before[k] for k in before}
+
+def _child(mode: str) -> dict:
+    import numpy as np
+    import faiss_search
+
+    if mode == "f16":
+        faiss_search._load_meta()  # проверка числа строк; в замер матрицы не входит
+    before = _mem_kb()
+    t0 = time.perf_counter()
+    if mode == "f16":
+        obj = faiss_search._load_embeddings()
+        faiss_search.get_vectors(np.arange(12))
+    else:
+        obj = faiss_search.read_index(mmap=(mode == "mmap"))
+    load_ms = (time.perf_counter() - t0) * 1000
+    loaded = _mem_kb()
+
+    t0 = time.perf_counter()
+    if mode == "f16":
+        float(np.asarray(obj, dtype=np.float32).sum())  # тронуть все страницы
+    else:
+        obj.search(np.zeros((1, obj.d), dtype="float32"), 24)
+    touch_ms = (time.perf_counter() - t0) * 1000
+    touched = _mem_kb()
+
+    return {
+        "load_ms": round(load_ms, 3),
+        "touch_ms": round(touch_ms, 3),
+        "rss_load_kb": _delta(loaded, before)["rss"],
+        "anon_load_kb": _delta(loaded, before)["anonymous"],
+        "rss_touch_kb": _delta(touched, before)["rss"],
+        "anon_touch_kb": _delta(touched, before)["anonymous"],
+    }
+
+def run(modes: list[str], repeat: int) -> dict:
+    report = {}
+    for mode in modes:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", mode],
+                cwd=BASE_DIR, capture_output=True, text=True, check=True,
+            )
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        report[mode] = {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+    return report
+
+def print_report(report: dict) -> None:
+    cols = ("load_ms", "touch_ms", "rss_load_kb", "anon_load_kb", "rss_touch_kb", "anon_touch_kb")
+    print(f"{'mode':<6}" + "".join(f"{c:>15}" for c in cols))
+    for mode, row in report.items():
+        print(f"{mode:<6}" + "".join(f"{row[c]:>15}" for c in cols))
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Benchmark FAISS index / embedding matrix load time and memory.")
+    p.add_argument("--modes", default=",".join(MODES), help=f"comma-separated subset of {','.join(MODES)}")
+    p.add_argument("--repeat", type=int, default=5, help="fresh processes per mode (median is reported)")
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    p.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.child:
+        print(json.dumps(_child(args.child)))
+        sys.exit(0)
+
+    report = run([m for m in args.modes.split(",") if m], args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
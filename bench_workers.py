@@ -0,0 +1,174 @@
+# bench_workers.py — масштабирование 1→N воркеров gunicorn (throughput, латентность, память)
+#
+# Для каждого числа воркеров поднимает `gunicorn -c gunicorn.conf.py "loadtest:stub_app()"`
+# (внешние API — заглушки loadtest.py, Postgres — локальный DATABASE_URL),
+# прогоняет одну и ту же seed-последовательность апдейтов по HTTP и снимает
+# RSS/PSS master + воркеров. PSS показывает, сколько реально стоит каждый
+# воркер с учётом copy-on-write страниц модели и индекса.
+#
+#   DATABASE_URL=postgresql://postgres@localhost/helpplants \
+#   python bench_workers.py --workers 1,2,4 --requests 400 --concurrency 32 --init-db
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import subprocess
+from pathlib import Path
+
+import httpx
+
+import loadtest
+from db import close_pool
+
+BASE_DIR = Path(__file__).resolve().parent
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _children(pid: int) -> list[int]:
+    out = []
+    for task in Path(f"/proc/{pid}/task").iterdir():
+        children = (task / "children").read_text().split()
+        out.extend(int(c) for c in children)
+    return out
+
+def _mem_kb(pid: int) -> dict[str, int]:
+    mem = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key in ("Rss", "Pss"):
+            mem[key.lower()] = int(value.split()[0])
+    return mem
+
+async def _wait_ready(base_url: str, proc: subprocess.Popen, workers: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url, timeout=2) as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with {proc.returncode}")
+            try:
+                ok = (await client.get("/metrics")).status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            if ok and len(_children(proc.pid)) >= workers:
+                return
+            await asyncio.sleep(0.5)
+    raise TimeoutError("gunicorn did not become ready")
+
+async def _drive(base_url: str, updates, concurrency: int) -> dict:
+    rec = loadtest.StageRecorder()
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        async def one(kind, update):
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    rsp = await client.post("/webhook", json=update)
+                    if not rsp.json().get("ok"):
+                        rec.error(f"webhook.{kind}")
+                except Exception:
+                    rec.error(f"webhook.{kind}")
+                finally:
+                    rec.add(f"webhook.{kind}", time.perf_counter() - t0)
+                    rec.add("webhook", time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(kind, upd) for kind, upd in updates))
+        wall = time.perf_counter() - t0
+    return {"wall_s": round(wall, 3), "throughput_rps": round(len(updates) / wall, 2),
+            "stages": loadtest.summarize(rec, wall)}
+
+async def _reset_db(init: bool) -> None:
+    await loadtest.prepare_db(init, True)
+    await close_pool()
+
+def bench_one(workers: int, args) -> dict:
+    asyncio.run(_reset_db(args.init_db))
+    port = _free_port()
+    env = dict(
+        os.environ,
+        WEB_CONCURRENCY=str(workers),
+        PORT=str(port),
+        RATE_LIMIT_BACKEND=args.rate_limit_backend,
+        LOADTEST_SEED=str(args.seed),
+        LOADTEST_PLANT_ID_MS=str(args.plant_id_ms),
+        LOADTEST_LLM_MS=str(args.llm_ms),
+        LOADTEST_TELEGRAM_MS=str(args.telegram_ms),
+        LOADTEST_STUB_RETRIEVAL="1" if args.stub_retrieval else "0",
+        PRELOAD_MODELS="0" if args.stub_retrieval else "1",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "loadtest:stub_app()"],
+        cwd=BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        asyncio.run(_wait_ready(base_url, proc, workers, args.startup_timeout))
+        updates = loadtest.build_updates(args.seed, args.requests, args.mix, args.users)
+        result = asyncio.run(_drive(base_url, updates, args.concurrency))
+
+        master = _mem_kb(proc.pid)
+        worker_mem = [_mem_kb(pid) for pid in _children(proc.pid)]
+        result.update({
+            "workers": workers,
+            "master_rss_mb": round(master["rss"] / 1024, 1),
+            "worker_rss_mb": [round(m["rss"] / 1024, 1) for m in worker_mem],
+            "total_pss_mb": round((master["pss"] + sum(m["pss"] for m in worker_mem)) / 1024, 1),
+        })
+        return result
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=args.startup_timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark /webhook throughput and memory for 1..N gunicorn workers.")
+    p.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    p.add_argument("--rate-limit-backend", default="postgres", choices=("memory", "postgres"),
+                   help="memory is only valid with a single worker")
+    p.add_argument("--startup-timeout", type=float, default=180)
+    p.add_argument("--verbose", action="store_true", help="show gunicorn logs")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--requests", type=int, default=400)
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--mix", default=loadtest.DEFAULT_MIX)
+    p.add_argument("--plant-id-ms", type=float, default=800)
+    p.add_argument("--llm-ms", type=float, default=1500)
+    p.add_argument("--telegram-ms", type=float, default=40)
+    p.add_argument("--stub-retrieval", action="store_true")
+    p.add_argument("--init-db", action="store_true")
+    p.add_argument("--json", help="write results to this path")
+    args = p.parse_args(argv)
+    if args.rate_limit_backend == "memory" and any(int(w) > 1 for w in args.workers.split(",")):
+        p.error("--rate-limit-backend memory requires --workers 1 (gunicorn.conf.py refuses it otherwise)")
+    return args
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    results = [bench_one(int(w), args) for w in args.workers.split(",")]
+
+    print(f"{'workers':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+          f"{'master MB':>11}{'worker RSS MB':>16}{'total PSS MB':>14}")
+    for r in results:
+        s = r["stages"]["webhook"]
+        errors = sum(st["errors"] for st in r["stages"].values())
+        print(f"{r['workers']:>8}{r['throughput_rps']:>10}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}"
+              f"{errors:>8}{r['master_rss_mb']:>11}{max(r['worker_rss_mb'] or [0]):>16}{r['total_pss_mb']:>14}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
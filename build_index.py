@@ -0,0 +1,96 @@
+# build_index.py — сборка FAISS-индекса и float16-матрицы векторов из clean_chunks.jsonl
+#
+#   python build_index.py                # clean_chunks.jsonl -> faiss_index.bin + faiss_metadata.pkl
+#                                        #   + faiss_embeddings.f16.npy
+#   python build_index.py --export       # только .npy из готового faiss_index.bin (без энкодера)
+#
+# Строка i матрицы == meta[i] == id в индексе. Матрицу открывает
+# faiss_search.get_vectors через np.load(mmap_mode="r") — для реранкинга,
+# дедупа и аналитики без чтения всего индекса в память.
+# Файлы пишутся во временный рядом и подменяются os.replace: процессы,
+# которые уже смапили старую версию, дочитают её целиком.
+import os
+import json
+import pickle
+import logging
+import argparse
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from faiss_search import INDEX_PATH, META_PATH, EMB_PATH, _load_model, _to_text_field
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("build_index")
+
+CHUNKS_PATH = Path("clean_chunks.jsonl")
+F16_MAX = float(np.finfo(np.float16).max)
+
+def _replace(path: Path, write) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+def save_embeddings(vectors: np.ndarray, path: Path = EMB_PATH) -> np.ndarray:
+    if np.abs(vectors).max(initial=0.0) > F16_MAX:
+        raise ValueError("vectors exceed float16 range")
+    emb = np.ascontiguousarray(vectors, dtype=np.float16)
+
+    def write(tmp: Path) -> None:
+        with tmp.open("wb") as f:
+            np.save(f, emb)
+    _replace(path, write)
+    return emb
+
+def _load_chunks(path: Path) -> list[dict]:
+    chunks = []
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                chunks.append(json.loads(line))
+    return chunks
+
+def build(chunks_path: Path = CHUNKS_PATH, batch_size: int = 64) -> dict:
+    meta = _load_chunks(chunks_path)
+    texts = [_to_text_field(c) for c in meta]
+    vectors = _load_model().encode(
+        texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=True
+    ).astype("float32")
+
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+
+    def write_meta(tmp: Path) -> None:
+        with tmp.open("wb") as f:
+            pickle.dump(meta, f)
+    _replace(INDEX_PATH, lambda tmp: faiss.write_index(index, str(tmp)))
+    _replace(META_PATH, write_meta)
+    emb = save_embeddings(vectors)
+    return {"rows": index.ntotal, "dim": index.d, "max_f16_error": _f16_error(vectors, emb)}
+
+def export(index_path: Path = INDEX_PATH) -> dict:
+    """float16-матрица из существующего индекса: reconstruct_n без повторного encode."""
+    index = faiss.read_index(str(index_path))
+    with META_PATH.open("rb") as f:
+        meta = pickle.load(f)
+    if index.ntotal != len(meta):
+        raise RuntimeError(f"FAISS/meta mismatch: index.ntotal={index.ntotal} != len(meta)={len(meta)}")
+    vectors = index.reconstruct_n(0, index.ntotal)
+    emb = save_embeddings(vectors)
+    return {"rows": index.ntotal, "dim": index.d, "max_f16_error": _f16_error(vectors, emb)}
+
+def _f16_error(vectors: np.ndarray, emb: np.ndarray) -> float:
+    if not len(vectors):
+        return 0.0
+    return float(np.abs(vectors - emb.astype("float32")).max())
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Build the FAISS index and the float16 embedding matrix.")
+    p.add_argument("--export", action="store_true",
+                   help="only write the float16 matrix from the existing faiss_index.bin")
+    p.add_argument("--chunks", type=Path, default=CHUNKS_PATH, help="source JSONL for a full rebuild")
+    p.add_argument("--batch-size", type=int, default=64, help="encoder batch size")
+    args = p.parse_args()
+    stats = export() if args.export else build(args.chunks, args.batch_size)
+    logger.info(f"[BUILD] {'export ' if args.export else ''}" + " ".join(f"{k}={v}" for k, v in stats.items()))
@@ -1,18 +1,113 @@
 from html import escape
+from functools import lru_cache
+from typing import Callable, NamedTuple
 from schemas import Card
+from profiling import profiled
 
-def render_html(c: Card) -> str:
-    parts = [f"<b>🌿 {escape(c.title)}</b>", escape(c.summary)]
+TELEGRAM_LIMIT = 4096  # лимит длины одного сообщения Telegram
+
+class _Layout(NamedTuple):
+    title: str
+    block: str
+    tips: str
+    tip: str
+    sources: str
+    source: str
+    esc: Callable[[str], str]
+
+# Шаблоны раскладки по форматам. Меняешь вёрстку здесь — и прогоняешь
+# rerender_cards.py: карточки перерисуются из gpt_cards.card_json без GPT.
+LAYOUTS = {
+    "html": _Layout(
+        title="<b>🌿 {}</b>",
+        block="• {}",
+        tips="<i>Советы:</i>\n{}",
+        tip="◦ {}",
+        sources="<i>Источники:</i>\n{}",
+        source='<a href="{0}">{0}</a>',
+        esc=escape,
+    ),
+    "text": _Layout(
+        title="🌿 {}",
+        block="• {}",
+        tips="Советы:\n{}",
+        tip="◦ {}",
+        sources="Источники:\n{}",
+        source="{}",
+        esc=str,
+    ),
+}
 
-    for block in c.blocks:
-        parts.append(f"• {escape(block)}")
+def render(c: Card, fmt: str = "html") -> str:
+    lt = LAYOUTS[fmt]
+    esc = lt.esc
+    parts = [lt.title.format(esc(c.title)), esc(c.summary)]
+    parts.extend(lt.block.format(esc(block)) for block in c.blocks)
 
     if c.tips:
-        tips_html = "\n".join(f"◦ {escape(tip)}" for tip in c.tips)
-        parts.append(f"<i>Советы:</i>\n{tips_html}")
+        parts.append(lt.tips.format("\n".join(lt.tip.format(esc(tip)) for tip in c.tips)))
 
     if c.sources:
-        src_html = "\n".join(f'<a href="{escape(url)}">{escape(url)}</a>' for url in c.sources)
-        parts.append(f"<i>Источники:</i>\n{src_html}")
+        parts.append(lt.sources.format("\n".join(lt.source.format(esc(str(url))) for url in c.sources)))
 
     return "\n\n".join(parts)
+
+@profiled("card.render_html")
+def render_html(c: Card) -> str:
+    return render(c, "html")
+
+def _cut_point(line: str, limit: int) -> int:
+    """Позиция разреза строки длиннее limit: по пробелу, не внутри <тега> и &сущности;."""
+    cut = limit
+    space = line.rfind(" ", limit // 2, limit)
+    if space != -1:
+        cut = space + 1
+    tag = line.rfind("<", 0, cut)
+    if tag > line.rfind(">", 0, cut):
+        cut = tag
+    amp = line.rfind("&", 0, cut)
+    if amp != -1 and ";" not in line[amp:cut]:
+        cut = amp
+    return cut if cut > 0 else limit
+
+def split_message(text: str, limit: int = TELEGRAM_LIMIT) -> list[str]:
+    """Режет текст на сообщения ≤ limit по границам абзацев, затем строк.
+
+    Абзацы карточки — законченные HTML-элементы, поэтому теги не рвутся.
+    Строку длиннее limit режем по пробелу (_cut_point), не разрывая тег
+    или HTML-сущность — иначе Telegram отклонит часть с "can't parse entities".
+    """
+    if len(text) <= limit:
+        return [text]
+    out, cur = [], ""
+    for para in text.split("\n\n"):
+        if len(para) <= limit:
+            units = [(para, "\n\n")]
+        else:
+            lines = []
+            for line in para.split("\n"):
+                while len(line) > limit:
+                    cut = _cut_point(line, limit)
+                    lines.append(line[:cut])
+                    line = line[cut:]
+                lines.append(line)
+            units = [(lines[0], "\n\n")] + [(line, "\n") for line in lines[1:]]
+        for unit, sep in units:
+            if cur and len(cur) + len(sep) + len(unit) <= limit:
+                cur += sep + unit
+            else:
+                if cur:
+                    out.append(cur)
+                cur = unit
+    if cur:
+        out.append(cur)
+    return out
+
+# --- Рендер из сохранённого JSON (gpt_cards.card_json), мемоизирован по строке JSON
+@lru_cache(maxsize=2048)
+def render_json(card_json: str, fmt: str = "html") -> str:
+    return render(Card.model_validate_json(card_json), fmt)
+
+@lru_cache(maxsize=2048)
+def render_chunks(card_json: str, fmt: str = "html", limit: int = TELEGRAM_LIMIT) -> tuple[str, ...]:
+    return tuple(split_message(render_json(card_json, fmt), limit))
@@ -0,0 +1,61 @@
+# db.py — общий пул asyncpg на процесс (service + limit_checker)
+#
+# Пул создаётся лениво, уже в воркере: при gunicorn --preload соединения
+# не должны переживать fork. Размер пула — на воркер, т.е. всего к Postgres
+# уходит до WEB_CONCURRENCY * PG_POOL_MAX соединений.
+import os
+from pathlib import Path
+from urllib.parse import urlparse
+
+import asyncpg
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+parsed = urlparse(DATABASE_URL) if DATABASE_URL else None
+
+PG_USER = parsed.username if parsed else None
+PG_PASSWORD = parsed.password if parsed else None
+PG_HOST = parsed.hostname if parsed else None
+PG_PORT = parsed.port if parsed else None
+PG_DB = parsed.path[1:] if parsed and parsed.path.startswith('/') else None
+
+SCHEMA_PATH = Path(__file__).resolve().parent / "schema.sql"
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+
+_pool = None
+
+async def get_pool():
+    """Возвращает кэшированный пул соединений asyncpg."""
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            host=PG_HOST,
+            port=PG_PORT,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            database=PG_DB,
+            min_size=PG_POOL_MIN,
+            max_size=PG_POOL_MAX,
+        )
+    return _pool
+
+async def apply_schema(lock_timeout: str = "5s") -> None:
+    """Применяет schema.sql (migrate.py, loadtest.py --init-db). Advisory-lock — от параллельных прогонов.
+
+    ALTER TABLE ... IF NOT EXISTS берёт ACCESS EXCLUSIVE даже без изменений:
+    lock_timeout — чтобы миграция падала, а не выстраивала чтения gpt_cards
+    в очередь за долгой транзакцией (rerender_cards.py).
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT set_config('lock_timeout', $1, true)", lock_timeout)
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('helpplants.schema'))")
+            await conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
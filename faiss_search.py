@@ -1,34 +1,93 @@
 # faiss_search.py — CTX-совместимый retrieval с fallback и MMR
+import os
 import faiss
 import pickle
+import logging
 import numpy as np
 import re
+import functools
+import threading
 from functools import lru_cache
 from sentence_transformers import SentenceTransformer
 from pathlib import Path
 from typing import List, Dict, Optional
+from metrics import stage, fallback
+from profiling import profiled
 
 INDEX_PATH = Path("faiss_index.bin")
 META_PATH = Path("faiss_metadata.pkl")
+# float16-копия векторов индекса, строка i == meta[i] (build_index.py)
+EMB_PATH = Path("faiss_embeddings.f16.npy")
+
+# индекс читается через mmap (страницы файла общие для всех процессов),
+# если сборка faiss это поддерживает; FAISS_MMAP=0 — обычное чтение в heap
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
 
 # Константы пайплайна
 DEFAULT_TOP_K = 12
 CLIP = 450
 
+logger = logging.getLogger("faiss")
+
 # --- Lazy loaders ---
-@lru_cache(maxsize=1)
+def _once(loader):
+    """lru_cache(maxsize=1) под локом: первые параллельные запросы из потоков
+    asyncio.to_thread иначе грузят каждый свою копию модели/индекса."""
+    cached = lru_cache(maxsize=1)(loader)
+    lock = threading.Lock()
+
+    @functools.wraps(loader)
+    def wrapper():
+        with lock:
+            return cached()
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+def read_index(path: Path = INDEX_PATH, mmap: bool = FAISS_MMAP):
+    if mmap:
+        # IO_FLAG_MMAP_IFC (faiss >= 1.9) мапит коды IndexFlat*; старый IO_FLAG_MMAP
+        # для плоского индекса игнорируется и читает в heap — результат тот же
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        try:
+            return faiss.read_index(str(path), flag)
+        except RuntimeError as e:
+            logger.warning(f"[FAISS] mmap read failed, loading into memory: {e}")
+    return faiss.read_index(str(path))
+
+@_once
 def _load_index():
-    return faiss.read_index(str(INDEX_PATH))
+    return read_index()
 
-@lru_cache(maxsize=1)
+@_once
 def _load_meta() -> List[Dict]:
     with META_PATH.open("rb") as f:
         return pickle.load(f)  # ожидается list[dict] с полями: content|text, latin_name, intent?, source?
 
-@lru_cache(maxsize=1)
+@_once
+def _load_embeddings() -> np.ndarray:
+    """Матрица (ntotal, dim) float16, открытая через mmap — в память не читается."""
+    if not EMB_PATH.exists():
+        raise FileNotFoundError(f"{EMB_PATH} not found, run: python build_index.py --export")
+    emb = np.load(EMB_PATH, mmap_mode="r")
+    meta = _load_meta()
+    if emb.ndim != 2 or emb.shape[0] != len(meta):
+        raise RuntimeError(f"embeddings/meta mismatch: shape={emb.shape} != len(meta)={len(meta)}")
+    return emb
+
+@_once
 def _load_model():
     return SentenceTransformer("paraphrase-multilingual-mpnet-base-v2")
 
+def warmup() -> None:
+    """Грузит индекс, метаданные и энкодер заранее (gunicorn --preload, до fork).
+
+    Воркеры наследуют их страницы copy-on-write. Энкодер здесь намеренно не
+    вызываем: пул потоков torch, поднятый до fork, в дочерних процессах виснет.
+    """
+    _load_index()
+    _load_meta()
+    _load_model()
+
 # --- Helpers ---
 _author_rx = re.compile(r"\b([A-Z][a-z]+|[A-Z]\.|[A-Z][a-z]+\.)$")
 
@@ -66,6 +125,7 @@ def _to_text_field(item: Dict) -> str:
         return str(item["content"])
     return ""
 
+@profiled("faiss._clip")
 def _clip(x: str, n: int = CLIP) -> str:
     if len(x) <= n:
         return x
@@ -77,6 +137,7 @@ def _clip(x: str, n: int = CLIP) -> str:
             return cut[:pos+1].strip() + "…"
     return cut.rsplit(" ", 1)[0].strip() + "…"
 
+@profiled("faiss.overlap")
 def overlap(a: str, b: str) -> bool:
     # грубая проверка сходства по 5-граммам
     def grams(s): return {s[i:i+5] for i in range(max(0, len(s)-4))}
@@ -84,18 +145,85 @@ def overlap(a: str, b: str) -> bool:
     return len(ga & gb) / max(1, len(ga | gb)) > 0.6
 
 # --- API ---
+def get_vectors(ids) -> np.ndarray:
+    """Векторы строк ids (индексы meta / FAISS) из float16-матрицы, shape (len(ids), dim).
+
+    Непрерывный возрастающий диапазон — read-only view на mmap без копирования,
+    иначе копируются только запрошенные строки.
+    """
+    emb = _load_embeddings()
+    ids = np.asarray(ids, dtype=np.int64)
+    if ids.ndim != 1:
+        raise ValueError("ids must be one-dimensional")
+    if len(ids) and ((ids < 0) | (ids >= emb.shape[0])).any():
+        raise IndexError(f"row id out of range [0, {emb.shape[0]})")
+    if len(ids) and (len(ids) == 1 or (np.diff(ids) == 1).all()):
+        return emb[ids[0]:ids[-1] + 1]
+    return emb[ids]
+
 def filter_by_intent(chunks: List[Dict], intent: Optional[str]) -> List[Dict]:
     if not intent or intent.lower() == "general":
         return chunks
     key = intent.strip().lower()
     return [c for c in chunks if str(c.get("intent", "")).lower() == key]
 
-def get_chunks_by_latin_name(
-    latin_name: str,
-    top_k: int = DEFAULT_TOP_K,
-    mode: str = "species",
-    intent: Optional[str] = None,
-) -> List[Dict]:
+def _rank(_latin: str, _mode: str, D, I, meta: List[Dict], top_k: int, intent: Optional[str]) -> List[Dict]:
+    seen, results = set(), []
+    species_key = _strip_authors(_latin).lower()
+    genus = _latin.split()[0].lower()
+
+    for row_d, row_i in zip(D, I):
+        for score, idx in zip(row_d.tolist(), row_i.tolist()):
+            if idx < 0 or idx >= len(meta) or idx in seen:
+                continue
+            raw = dict(meta[idx])
+            ln = str(raw.get("latin_name", "")).lower()
+
+            if _mode == "genus" and not ln.startswith(genus):
+                continue
+
+            if species_key and species_key in ln:
+                match = "species"
+            elif genus and ln.startswith(genus):
+                match = "genus"
+            else:
+                match = "none"
+
+            text = _to_text_field(raw).strip()
+            if not text:
+                continue
+
+            results.append({
+                "text": _clip(text, CLIP),
+                "latin_name": raw.get("latin_name") or "",
+                "intent": raw.get("intent"),
+                "source": raw.get("source"),
+                "score": float(score),
+                "match": match,
+            })
+            seen.add(idx)
+
+    # intent-фильтр (если задан и не general)
+    if intent and intent.lower() != "general":
+        results = [r for r in results if str(r.get("intent", "")).lower() == intent.lower()]
+
+    # предварительная сортировка
+    results.sort(key=lambda x: (x["match"] == "species", x["match"] == "genus", x["score"]), reverse=True)
+
+    # MMR-диверсификация по тексту
+    selected, used = [], set()
+    for r in results:
+        txt = r["text"][:200]
+        if any(overlap(txt, s) for s in used):
+            continue
+        selected.append(r)
+        used.add(txt)
+        if len(selected) >= top_k:
+            break
+    return selected
+
+def _search_many(passes: List[tuple]) -> List[List[Dict]]:
+    """Один encode + один index.search на все проходы: [(latin, mode, top_k, intent)]."""
     index = _load_index()
     meta = _load_meta()
     model = _load_model()
@@ -103,84 +231,65 @@ def get_chunks_by_latin_name(
     if index.ntotal != len(meta):
         raise RuntimeError(f"FAISS/meta mismatch: index.ntotal={index.ntotal} != len(meta)={len(meta)}")
 
-    def _search(_latin: str, _mode: str):
-        queries, input_rank, input_genus = _build_queries(_latin)
-        q_vecs = model.encode(queries, convert_to_numpy=True).astype("float32")
-
-        over_k = max(top_k * 3, 24)
-        D, I = index.search(q_vecs, over_k)
-
-        seen, results = set(), []
-        species_key = _strip_authors(_latin).lower()
-        genus = _latin.split()[0].lower()
-
-        for row_d, row_i in zip(D, I):
-            for score, idx in zip(row_d.tolist(), row_i.tolist()):
-                if idx < 0 or idx >= len(meta) or idx in seen:
-                    continue
-                raw = dict(meta[idx])
-                ln = str(raw.get("latin_name", "")).lower()
-
-                if _mode == "genus" and not ln.startswith(genus):
-                    continue
-
-                if species_key and species_key in ln:
-                    match = "species"
-                elif genus and ln.startswith(genus):
-                    match = "genus"
-                else:
-                    match = "none"
-
-                text = _to_text_field(raw).strip()
-                if not text:
-                    continue
-
-                results.append({
-                    "text": _clip(text, CLIP),
-                    "latin_name": raw.get("latin_name") or "",
-                    "intent": raw.get("intent"),
-                    "source": raw.get("source"),
-                    "score": float(score),
-                    "match": match,
-                })
-                seen.add(idx)
-
-        # intent-фильтр (если задан и не general)
-        if intent and intent.lower() != "general":
-            results = [r for r in results if str(r.get("intent", "")).lower() == intent.lower()]
-
-        # предварительная сортировка
-        results.sort(key=lambda x: (x["match"] == "species", x["match"] == "genus", x["score"]), reverse=True)
-
-        # MMR-диверсификация по тексту
-        selected, used = [], set()
-        for r in results:
-            txt = r["text"][:200]
-            if any(overlap(txt, s) for s in used):
-                continue
-            selected.append(r)
-            used.add(txt)
-            if len(selected) >= top_k:
-                break
-        return selected
+    # одинаковые строки запросов (один вид в нескольких запросах) кодируем один раз
+    rows: Dict[str, int] = {}
+    per_pass = []
+    for _latin, _mode, _top_k, _intent in passes:
+        queries, _, _ = _build_queries(_latin)
+        per_pass.append([rows.setdefault(q, len(rows)) for q in queries])
+
+    with stage("embed"), profiled("faiss.encode"):
+        q_vecs = model.encode(list(rows), convert_to_numpy=True).astype("float32")
 
-    # 1-й проход: species
-    results = _search(latin_name, "species")
+    # плоский индекс точный: поиск с max(over_k) и срез первых over_k == поиск с over_k
+    over_ks = [max(_top_k * 3, 24) for _, _, _top_k, _ in passes]
+    with stage("search"), profiled("faiss.index_search"):
+        D, I = index.search(q_vecs, max(over_ks))
+
+    out = []
+    with stage("mmr"):
+        for (_latin, _mode, _top_k, _intent), row_ids, over_k in zip(passes, per_pass, over_ks):
+            out.append(_rank(_latin, _mode, D[row_ids, :over_k], I[row_ids, :over_k], meta, _top_k, _intent))
+    return out
+
+@profiled("faiss.search_batch")
+def search_batch(queries: List[tuple]) -> List[List[Dict]]:
+    """Пакетный retrieval: [(latin_name, intent, top_k)] -> результаты в том же порядке.
+
+    Species-проходы всех запросов идут одним encode/search, fallback по роду —
+    вторым общим проходом только для пустых.
+    """
+    results = _search_many([(latin, "species", top_k, intent) for latin, intent, top_k in queries])
 
     # Fallback: если пусто — пробуем по роду
-    used_mode = "species"
-    if not results:
-        used_mode = "species->genus"
-        genus = latin_name.split()[0]
-        results = _search(genus, "genus")
+    empty = [i for i, r in enumerate(results) if not r]
+    if empty:
+        genus_passes = []
+        for i in empty:
+            latin, intent, top_k = queries[i]
+            fallback("genus")
+            genus_passes.append((latin.split()[0], "genus", top_k, intent))
+        for i, r in zip(empty, _search_many(genus_passes)):
+            results[i] = r
 
+    fell_back = set(empty)
     try:
-        import logging as _lg
-        _lg.getLogger("faiss").info(
-            f"[FAISS] retrieved_k={len(results)} used_k={min(len(results), top_k)} "
-            f"mode={used_mode} intent={intent or '-'} q='{latin_name}'"
-        )
+        for i, ((latin_name, intent, top_k), r) in enumerate(zip(queries, results)):
+            used_mode = "species->genus" if i in fell_back else "species"
+            logger.info(
+                f"[FAISS] retrieved_k={len(r)} used_k={min(len(r), top_k)} "
+                f"mode={used_mode} intent={intent or '-'} q='{latin_name}'"
+            )
     except Exception:
         pass
 
     return results
+
+@profiled("faiss.get_chunks_by_latin_name")
+def get_chunks_by_latin_name(
+    latin_name: str,
+    top_k: int = DEFAULT_TOP_K,
+    mode: str = "species",
+    intent: Optional[str] = None,
+) -> List[Dict]:
+    return search_batch([(latin_name, intent, top_k)])[0]
@@ -0,0 +1,59 @@
+# gunicorn.conf.py — multi-worker режим: preload + fork после загрузки модели/индекса
+#
+#   WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py main:app
+#
+# Master импортирует main и (PRELOAD_MODELS=1) грузит FAISS-индекс, метаданные
+# и энкодер; воркеры получают их страницы copy-on-write вместо N копий в RAM.
+# Состояние между воркерами — только через Postgres: при workers > 1
+# RATE_LIMIT_BACKEND по умолчанию postgres, memory — отказ стартовать.
+import gc
+import os
+import sys
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+# с отдельным retrieval-сервисом (RETRIEVAL_SOCKET/RETRIEVAL_URL) модель воркерам не нужна
+_REMOTE_RETRIEVAL = bool(os.getenv("RETRIEVAL_SOCKET") or os.getenv("RETRIEVAL_URL"))
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "0" if _REMOTE_RETRIEVAL else "1") == "1"
+
+# Prometheus: у каждого воркера свой процесс — метрики агрегируются через файлы.
+# Переменная должна быть выставлена до импорта prometheus_client (preload main).
+if workers > 1:
+    # memory-бэкенд держит паузу BLOCK 1 в каждом воркере отдельно
+    if os.environ.setdefault("RATE_LIMIT_BACKEND", "postgres") != "postgres":
+        raise RuntimeError(
+            f"RATE_LIMIT_BACKEND={os.environ['RATE_LIMIT_BACKEND']} is per-process; "
+            f"use postgres with WEB_CONCURRENCY={workers}"
+        )
+    _prom_dir = os.environ.setdefault(
+        "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "helpplants-prometheus")
+    )
+    shutil.rmtree(_prom_dir, ignore_errors=True)
+    os.makedirs(_prom_dir, exist_ok=True)
+
+def on_starting(server):
+    if PRELOAD_MODELS:
+        import faiss_search
+        faiss_search.warmup()
+        server.log.info("[PRELOAD] FAISS index, metadata and encoder loaded before fork")
+    # объекты, созданные до fork, уходят из поля зрения GC — иначе его проходы
+    # пишут в их заголовки и копируют общие страницы в каждый воркер
+    gc.freeze()
+
+def post_fork(server, worker):
+    # ядра делим между воркерами, иначе N процессов * все ядра torch
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
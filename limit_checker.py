@@ -1,18 +1,43 @@
 # BLOCK 2: daily limit checker for Plant.id recognitions
 import os
-from datetime import datetime
-import asyncpg
+from datetime import datetime, timedelta
+from profiling import profiled
+from db import get_pool
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+# BLOCK 1: пауза между распознаваниями одного пользователя.
+# memory — словарь в процессе (один воркер); postgres — общий для всех воркеров.
+RATE_LIMIT_SECONDS = 15
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
 
-_pool = None
+# storage for last recognition timestamps (backend=memory)
+user_last_request = {}
 
-async def get_pool():
-    global _pool
-    if _pool is None:
-        _pool = await asyncpg.create_pool(DATABASE_URL)
-    return _pool
+async def check_rate_limit(user_id: int, now: datetime) -> bool:
+    """Returns True and remembers `now` if the user may start a new recognition."""
+    if RATE_LIMIT_BACKEND == "postgres":
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            # атомарно: обновляем отметку, только если пауза уже прошла
+            allowed = await conn.fetchval(
+                """
+                INSERT INTO photo_rate_limit (user_id, last_at) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET last_at = EXCLUDED.last_at
+                WHERE photo_rate_limit.last_at <= EXCLUDED.last_at - $3::interval
+                RETURNING user_id
+                """,
+                user_id,
+                now,
+                timedelta(seconds=RATE_LIMIT_SECONDS),
+            )
+        return allowed is not None
+
+    last_time = user_last_request.get(user_id)
+    if last_time and (now - last_time).total_seconds() < RATE_LIMIT_SECONDS:
+        return False
+    user_last_request[user_id] = now
+    return True
 
+@profiled("pg.check_and_increment_limit")
 async def check_and_increment_limit(user_id: str) -> bool:
     """Check and update daily recognition limit.
 
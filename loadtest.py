@@ -0,0 +1,513 @@
+# loadtest.py — нагрузочный прогон /webhook in-process (Telegram Update → FastAPI → хендлеры)
+#
+# Plant.id, LLM и Telegram Bot API заменяются заглушками с детерминированной
+# задержкой, Postgres — локальный (DATABASE_URL). Один и тот же --seed даёт
+# одинаковую последовательность апдейтов и одинаковые задержки заглушек.
+#
+#   DATABASE_URL=postgresql://postgres@localhost/helpplants \
+#   python loadtest.py --requests 500 --concurrency 20 --seed 42 --init-db --reset-db \
+#       --json report.json [--baseline prev.json --max-regression 0.2]
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from types import SimpleNamespace
+
+# main.py собирает Application при импорте — токен нужен заранее
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("WEBHOOK_URL", "http://loadtest/webhook")
+os.environ.setdefault("PLANT_ID_API_KEY", "loadtest")
+os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+
+import httpx
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+BASE_DIR = Path(__file__).resolve().parent
+CATEGORY_MAP_PATH = BASE_DIR / "category_map.json"
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "BOTanik", "username": "loadtest_bot"}
+TEXT_BUTTONS = ["📘 Инфо", "📢 Канал", "ℹ️ О проекте"]
+DEFAULT_MIX = "photo=0.3,care=0.5,text=0.2"
+
+# минимальный валидный PNG (1x1) — проходит imghdr в handle_photo
+PNG_1X1 = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+# =========================
+#   Синтетические апдейты
+# =========================
+def _load_species() -> list[str]:
+    with CATEGORY_MAP_PATH.open(encoding="utf-8") as f:
+        return sorted(json.load(f))
+
+def _parse_mix(mix: str) -> dict[str, float]:
+    out = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        out[kind.strip()] = float(weight)
+    unknown = set(out) - {"photo", "care", "text"}
+    if unknown:
+        raise ValueError(f"unknown update kinds in --mix: {sorted(unknown)}")
+    return out
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"load{uid}", "language_code": "ru"}
+
+def _chat(uid: int) -> dict:
+    return {"id": uid, "type": "private"}
+
+def photo_update(update_id: int, uid: int, file_id: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": _chat(uid),
+            "from": _user(uid),
+            "photo": [
+                {"file_id": f"{file_id}-s", "file_unique_id": f"{file_id}-s", "width": 90, "height": 90, "file_size": 1024},
+                {"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 1280, "file_size": 256 * 1024},
+            ],
+        },
+    }
+
+def care_update(update_id: int, uid: int, latin_name: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": f"care:{latin_name}",
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": _chat(uid),
+                "from": BOT_USER,
+                "text": f"🌱 Похоже, это: {latin_name}",
+            },
+        },
+    }
+
+def text_update(update_id: int, uid: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": _chat(uid),
+            "from": _user(uid),
+            "text": text,
+        },
+    }
+
+def build_updates(seed: int, n: int, mix: str = DEFAULT_MIX, users: int = 1000,
+                  species: list[str] | None = None) -> list[tuple[str, dict]]:
+    """Детерминированная по seed последовательность (kind, update)."""
+    rnd = random.Random(seed)
+    weights = _parse_mix(mix)
+    kinds, probs = list(weights), list(weights.values())
+    species = species or _load_species()
+    # «популярные» виды запрашиваются чаще — иначе кэш карточек никогда не прогреется
+    popularity = [1.0 / (i + 1) for i in range(len(species))]
+
+    updates = []
+    for i in range(n):
+        kind = rnd.choices(kinds, probs)[0]
+        uid = 10_000 + rnd.randrange(users)
+        update_id = seed * 1_000_000 + i + 1
+        if kind == "photo":
+            updates.append((kind, photo_update(update_id, uid, f"photo-{seed}-{i}")))
+        elif kind == "care":
+            latin = rnd.choices(species, popularity)[0]
+            updates.append((kind, care_update(update_id, uid, latin)))
+        else:
+            updates.append((kind, text_update(update_id, uid, rnd.choice(TEXT_BUTTONS))))
+    return updates
+
+
+# =========================
+#   Замеры
+# =========================
+class StageRecorder:
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        # для --verify-writes: что должно оказаться в gpt_cards после shutdown
+        self.cards_generated: set[tuple[str, str]] = set()
+        self.cards_delivered = 0
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def error(self, stage: str) -> None:
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def wrap(self, stage: str, func):
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                self.error(stage)
+                raise
+            finally:
+                self.add(stage, time.perf_counter() - t0)
+        return wrapper
+
+def _percentile(sorted_xs: list[float], q: float) -> float:
+    if not sorted_xs:
+        return 0.0
+    idx = min(len(sorted_xs) - 1, max(0, int(round(q * len(sorted_xs) + 0.5)) - 1))
+    return sorted_xs[idx]
+
+def summarize(rec: StageRecorder, wall: float) -> dict:
+    stages = {}
+    for stage, xs in sorted(rec.samples.items()):
+        xs = sorted(xs)
+        stages[stage] = {
+            "count": len(xs),
+            "rps": round(len(xs) / wall, 2) if wall else 0.0,
+            "p50_ms": round(_percentile(xs, 0.50) * 1000, 2),
+            "p95_ms": round(_percentile(xs, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(xs, 0.99) * 1000, 2),
+            "max_ms": round(xs[-1] * 1000, 2),
+            "errors": rec.errors.get(stage, 0),
+        }
+    return stages
+
+def print_report(report: dict) -> None:
+    print(f"seed={report['seed']} requests={report['requests']} concurrency={report['concurrency']} "
+          f"wall={report['wall_s']}s throughput={report['throughput_rps']} rps")
+    print(f"{'stage':<22}{'count':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'err':>6}")
+    for stage, s in report["stages"].items():
+        print(f"{stage:<22}{s['count']:>8}{s['rps']:>9}{s['p50_ms']:>10}{s['p95_ms']:>10}"
+              f"{s['p99_ms']:>10}{s['max_ms']:>10}{s['errors']:>6}")
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Стадии, у которых p95 вырос больше чем на max_regression (доля)."""
+    regressions = []
+    for stage, cur in report["stages"].items():
+        prev = baseline.get("stages", {}).get(stage)
+        if not prev or not prev["p95_ms"]:
+            continue
+        delta = (cur["p95_ms"] - prev["p95_ms"]) / prev["p95_ms"]
+        print(f"[BASELINE] {stage:<22} p95 {prev['p95_ms']:>9} → {cur['p95_ms']:>9} ms ({delta:+.1%})")
+        if delta > max_regression:
+            regressions.append(stage)
+    return regressions
+
+
+# =========================
+#   Заглушки внешних сервисов
+# =========================
+def _stub_delay(seed: int, key: str, median_ms: float) -> float:
+    # задержка зависит только от (seed, key) — не от порядка вызовов при конкуренции
+    h = hashlib.blake2b(f"{seed}:{key}".encode(), digest_size=8).digest()
+    rnd = random.Random(int.from_bytes(h, "big"))
+    return rnd.lognormvariate(0, 0.35) * median_ms / 1000.0
+
+class StubTelegramRequest(BaseRequest):
+    """Bot API без сети: отвечает на методы, которые вызывают хендлеры."""
+
+    def __init__(self, seed: int, median_ms: float) -> None:
+        self.seed = seed
+        self.median_ms = median_ms
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if "/file/bot" in url:
+            await asyncio.sleep(_stub_delay(self.seed, url, self.median_ms))
+            # хвост после IEND не мешает imghdr, но делает фото (и ответ Plant.id) разными
+            return 200, PNG_1X1 + url.rsplit("/", 1)[-1].encode()
+
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "getFile":
+            file_id = params.get("file_id", "stub")
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_size": len(PNG_1X1), "file_path": f"photos/{file_id}.png"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            result = {"message_id": self._message_id, "date": int(time.time()),
+                      "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                      "from": BOT_USER, "text": str(params.get("text", ""))}
+        else:
+            # answerCallbackQuery, setWebhook, deleteWebhook, ...
+            result = True
+        key = f"{endpoint}:{params.get('chat_id', '')}:{str(params.get('text', ''))[:32]}"
+        await asyncio.sleep(_stub_delay(self.seed, key, self.median_ms))
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def _plant_id_transport(seed: int, median_ms: float, species: list[str], rec: StageRecorder):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        t0 = time.perf_counter()
+        body = request.content
+        rnd = random.Random(hashlib.blake2b(body, digest_size=8).digest() + str(seed).encode())
+        picks = rnd.sample(species, 3)
+        probs = sorted((rnd.uniform(0.05, 0.95) for _ in picks), reverse=True)
+        await asyncio.sleep(_stub_delay(seed, body[-64:].hex(), median_ms))
+        rec.add("plant_id", time.perf_counter() - t0)
+        return httpx.Response(200, json={
+            "is_plant_probability": rnd.uniform(0.1, 1.0),
+            "suggestions": [{"plant_name": n, "probability": p} for n, p in zip(picks, probs)],
+        })
+    return httpx.MockTransport(handler)
+
+class _StubCompletions:
+    def __init__(self, seed: int, median_ms: float, rec: StageRecorder) -> None:
+        self.seed = seed
+        self.median_ms = median_ms
+        self.rec = rec
+
+    async def create(self, model=None, messages=None, **kwargs):
+        payload = json.loads(messages[-1]["content"])
+        latin = payload["CTX"]["PLANT"]
+        facts = [f for f in payload.get("FACTS", []) if len(f) >= 5] or ["Нет данных в базе."]
+        card = {
+            "title": latin,
+            "summary": facts[0][:380],
+            "blocks": facts[:6],
+            "tips": ["Проверяйте влажность почвы перед поливом."],
+            "sources": [],
+        }
+        await asyncio.sleep(_stub_delay(self.seed, latin, self.median_ms))
+        self.rec.cards_generated.add((latin, payload["CTX"]["INTENT"]))
+        content = json.dumps(card, ensure_ascii=False)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=len(messages[-1]["content"]) // 4,
+                                  completion_tokens=len(content) // 4,
+                                  total_tokens=(len(messages[-1]["content"]) + len(content)) // 4),
+        )
+
+async def _stub_chunks(latin_name: str, top_k: int = 12, intent=None):
+    rnd = random.Random(latin_name)
+    return [{"text": f"{latin_name}: факт ухода №{i} — полив умеренный, свет рассеянный.",
+             "latin_name": latin_name, "intent": intent, "source": None,
+             "score": rnd.random(), "match": "species"} for i in range(min(top_k, 6))]
+
+async def _noop_warmup():
+    pass
+
+async def _stub_search_batch(queries):
+    return [await _stub_chunks(latin, top_k, intent) for latin, intent, top_k in queries]
+
+def install_stubs(seed: int, plant_id_ms: float = 800, llm_ms: float = 1500, telegram_ms: float = 40,
+                  stub_retrieval: bool = False, rec: StageRecorder | None = None) -> StageRecorder:
+    """Подменяет внешние сервисы в main/service и оборачивает стадии таймерами."""
+    import main
+    import service
+
+    rec = rec or StageRecorder()
+    species = _load_species()
+
+    # Telegram Bot API: webhook-режим, Updater не нужен (его initialize() ходит в сеть)
+    tg_request = StubTelegramRequest(seed, telegram_ms)
+    main.application.bot = ExtBot(main.TOKEN, request=tg_request, get_updates_request=tg_request)
+    main.application.updater = None
+
+    # Plant.id: main.py создаёт httpx.AsyncClient() на каждый запрос
+    transport = _plant_id_transport(seed, plant_id_ms, species, rec)
+    real_client = httpx.AsyncClient
+    main.httpx = SimpleNamespace(AsyncClient=lambda **kw: real_client(transport=transport, **kw))
+
+    # LLM
+    completions = _StubCompletions(seed, llm_ms, rec)
+    completions.create = rec.wrap("llm", completions.create)
+    service.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    # Retrieval: настоящий FAISS (in-process или RETRIEVAL_SOCKET) по умолчанию,
+    # заглушка — чтобы не грузить энкодер
+    retrieval = _stub_chunks if stub_retrieval else service.get_chunks
+    service.get_chunks = rec.wrap("retrieval", retrieval)
+    batch = _stub_search_batch if stub_retrieval else service.search_batch
+    service.search_batch = rec.wrap("retrieval_batch", batch)
+    if stub_retrieval:
+        main.retrieval_client.warmup = _noop_warmup
+
+    # Postgres
+    main.check_rate_limit = rec.wrap("rate_limit", main.check_rate_limit)
+    main.check_and_increment_limit = rec.wrap("limit_check", main.check_and_increment_limit)
+    service.get_card_by_latin_intent = rec.wrap("cache_lookup", service.get_card_by_latin_intent)
+    service.writer.flush = rec.wrap("write_flush", service.writer.flush)
+
+    generate_card = main.generate_card
+
+    async def counted_generate_card(*args, **kwargs):
+        html = await generate_card(*args, **kwargs)
+        if html != service.NO_DATA:
+            rec.cards_delivered += 1
+        return html
+    main.generate_card = counted_generate_card
+    return rec
+
+def stub_app():
+    """Фабрика для gunicorn: `gunicorn -c gunicorn.conf.py "loadtest:stub_app()"`.
+
+    Параметры заглушек — из LOADTEST_* (их выставляет bench_workers.py).
+    """
+    import main
+
+    install_stubs(
+        seed=int(os.getenv("LOADTEST_SEED", "1")),
+        plant_id_ms=float(os.getenv("LOADTEST_PLANT_ID_MS", "800")),
+        llm_ms=float(os.getenv("LOADTEST_LLM_MS", "1500")),
+        telegram_ms=float(os.getenv("LOADTEST_TELEGRAM_MS", "40")),
+        stub_retrieval=os.getenv("LOADTEST_STUB_RETRIEVAL", "0") == "1",
+    )
+    return main.app
+
+
+# =========================
+#   Postgres
+# =========================
+async def prepare_db(init: bool, reset: bool) -> None:
+    if not (init or reset):
+        return
+    from db import apply_schema, get_pool
+
+    if init:
+        await apply_schema()
+    if reset:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("TRUNCATE photo_usage, photo_rate_limit, gpt_cards")
+
+
+async def verify_writes(rec: StageRecorder) -> dict:
+    """После graceful shutdown: все карточки и hits из прогона должны быть в gpt_cards."""
+    from db import get_pool, close_pool
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT latin_name, intent, hits FROM gpt_cards WHERE card_json IS NOT NULL")
+    await close_pool()
+    stored = {(r["latin_name"], r["intent"]) for r in rows}
+    stored_hits = sum(r["hits"] for r in rows)
+    missing = rec.cards_generated - stored
+    return {
+        "expected_cards": len(rec.cards_generated),
+        "stored_cards": len(stored),
+        "missing_cards": sorted(f"{l}/{i}" for l, i in missing),
+        "expected_hits": rec.cards_delivered,
+        "stored_hits": stored_hits,
+        "ok": not missing and stored_hits == rec.cards_delivered,
+    }
+
+
+# =========================
+#   Прогон
+# =========================
+async def run(args) -> dict:
+    import main
+
+    rec = install_stubs(args.seed, args.plant_id_ms, args.llm_ms, args.telegram_ms,
+                        args.stub_retrieval)
+    await prepare_db(args.init_db, args.reset_db)
+    await main.startup()
+    if not main.app_state_ready:
+        raise RuntimeError("main.startup() failed, see log above")
+
+    updates = build_updates(args.seed, args.requests, args.mix, args.users)
+    sem = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=main.app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        async def one(kind: str, update: dict) -> None:
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    rsp = await client.post("/webhook", json=update)
+                    if not rsp.json().get("ok"):
+                        rec.error(f"webhook.{kind}")
+                except Exception:
+                    rec.error(f"webhook.{kind}")
+                finally:
+                    rec.add(f"webhook.{kind}", time.perf_counter() - t0)
+
+        t_start = time.perf_counter()
+        await asyncio.gather(*(one(kind, upd) for kind, upd in updates))
+        wall = time.perf_counter() - t_start
+
+    # graceful shutdown: write-behind буфер сбрасывается здесь
+    await main.shutdown()
+    writes = await verify_writes(rec) if args.verify_writes else None
+    return {
+        "seed": args.seed,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "mix": args.mix,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(updates) / wall, 2) if wall else 0.0,
+        "stages": summarize(rec, wall),
+        "writes": writes,
+    }
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Replay synthetic Telegram updates against /webhook in-process.")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.add_argument("--users", type=int, default=1000, help="size of the synthetic user pool")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="update kind weights, e.g. photo=0.3,care=0.5,text=0.2")
+    p.add_argument("--plant-id-ms", type=float, default=800, help="median stub Plant.id latency")
+    p.add_argument("--llm-ms", type=float, default=1500, help="median stub LLM latency")
+    p.add_argument("--telegram-ms", type=float, default=40, help="median stub Bot API latency")
+    p.add_argument("--stub-retrieval", action="store_true", help="skip the FAISS encoder/index")
+    p.add_argument("--init-db", action="store_true", help="apply schema.sql to DATABASE_URL")
+    p.add_argument("--reset-db", action="store_true", help="truncate photo_usage, photo_rate_limit and gpt_cards")
+    p.add_argument("--verify-writes", action="store_true",
+                   help="after shutdown, check that every generated card and hit reached gpt_cards (needs --reset-db)")
+    p.add_argument("--json", help="write the report to this path")
+    p.add_argument("--baseline", help="compare p95 per stage against a previous --json report")
+    p.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 growth vs baseline (fraction)")
+    return p.parse_args(argv)
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    if args.verify_writes and not args.reset_db:
+        raise SystemExit("--verify-writes needs --reset-db (hits are compared exactly)")
+    report = asyncio.run(run(args))
+    print_report(report)
+    writes = report["writes"]
+    if writes:
+        print(f"[WRITES] cards {writes['stored_cards']}/{writes['expected_cards']} "
+              f"hits {writes['stored_hits']}/{writes['expected_hits']} ok={writes['ok']}")
+        if not writes["ok"]:
+            return 1
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.max_regression)
+        if regressions:
+            print(f"[BASELINE] p95 regression > {args.max_regression:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -4,9 +4,13 @@ import os
 import logging
 import traceback
 import base64
+import asyncio
+import secrets
 import imghdr
+import re
+import hashlib
 from datetime import datetime
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response, HTTPException
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -16,6 +20,7 @@ from telegram import (
 )
 import json
 import httpx
+from html import escape
 
 with open(os.path.join(os.path.dirname(__file__), "latin_name_map.json"), encoding="utf-8") as f:
     latin_name_map = json.load(f)
@@ -24,13 +29,24 @@ from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
-from limit_checker import check_and_increment_limit
-from service import generate_card  # <-- CTX-пайплайн
+from limit_checker import check_and_increment_limit, check_rate_limit, RATE_LIMIT_SECONDS
+from service import (  # <-- CTX-пайплайн
+    generate_card, prefetch_card, warm_card_cache, run_in_background, cancel_background, rank_candidates,
+)
+from write_behind import writer
+from card_formatter import split_message
+from db import close_pool
+import retrieval_client
+import metrics
+from metrics import stage
+import profiling
+from profiling import profiled
 
 # --- Конфиги
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PLANT_ID_API_KEY = os.getenv("PLANT_ID_API_KEY")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # /admin/* выключены, если не задан
 
 # --- Логирование
 logging.basicConfig(level=logging.INFO)
@@ -64,15 +80,36 @@ app = FastAPI()
 application = Application.builder().token(TOKEN).build()
 app_state_ready = False
 
-# BLOCK 1: storage for last recognition timestamps
-user_last_request = {}
-
-os.makedirs("temp", exist_ok=True)
-
 def strip_tags(text: str) -> str:
-    import re
     return re.sub(r"<[^>]+>", "", text)
 
+# Telegram ограничивает callback_data 64 байтами. Длинное имя не режем (обрезок
+# ушёл бы в generate_card как несуществующий вид) — в кнопку кладём хэш, а имя
+# при нажатии находим среди кандидатов в тексте того же сообщения (строки
+# handle_photo). Состояния в процессе нет — работает на любом воркере и после рестарта.
+CALLBACK_DATA_LIMIT = 64
+_CANDIDATE_LINE = re.compile(r"^(?:🌱 Похоже, это: |• )(.+) \(\d+(?:\.\d+)?%\)")
+
+def _name_key(name: str) -> str:
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]
+
+def care_callback_data(name: str) -> str:
+    data = f"care:{name}"
+    if len(data.encode("utf-8")) <= CALLBACK_DATA_LIMIT:
+        return data
+    return f"care#{_name_key(name)}"
+
+def care_name(data: str, message_text: str | None) -> str | None:
+    """Имя из callback_data кнопки ухода; None — кандидата с таким хэшем в сообщении нет."""
+    if not data.startswith("care#"):
+        return data.split(":", 1)[1].strip()
+    key = data[len("care#"):]
+    for line in (message_text or "").splitlines():
+        m = _CANDIDATE_LINE.match(line)
+        if m and _name_key(m.group(1)) == key:
+            return m.group(1)
+    return None
+
 def clean_description(data: dict) -> dict:
     name = data.get("name", "").strip()
     desc = data.get("short_description", "").strip()
@@ -100,6 +137,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # --- Обработка фото
+@profiled("main.handle_photo")
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
@@ -115,17 +153,15 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"[BLOCK 1] Refuse album user {user_id} at {now.isoformat()} reason=album")
             return
 
-        # BLOCK 1: rate limiting between recognitions
-        last_time = user_last_request.get(user_id)
-        if last_time and (now - last_time).total_seconds() < 15:
+        # BLOCK 1: rate limiting between recognitions (общий стор при нескольких воркерах)
+        if not await check_rate_limit(user_id, now):
             await update.message.reply_text(
-                "⏱ Подождите 15 секунд перед новой попыткой.",
+                f"⏱ Подождите {RATE_LIMIT_SECONDS} секунд перед новой попыткой.",
                 parse_mode="HTML",
             )
             logger.info(
                 f"[BLOCK 1] Rate limit user {user_id} at {now.isoformat()} reason=rate_limit")
             return
-        user_last_request[user_id] = now
 
         photo = update.message.photo[-1]
         # BLOCK 1: size check before downloading
@@ -138,12 +174,13 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"[BLOCK 1] Reject large file from user {user_id} at {datetime.utcnow().isoformat()} size={photo.file_size} reason=size")
             return
 
-        file = await context.bot.get_file(photo.file_id)
-        temp_path = "temp/plant.jpg"
-        await file.download_to_drive(custom_path=temp_path)
+        # в память, а не в общий temp-файл: параллельные апдейты читали чужое фото
+        with stage("tg_download"):
+            file = await context.bot.get_file(photo.file_id)
+            image_bytes = bytes(await file.download_as_bytearray())
 
         # BLOCK 1: format check
-        img_type = imghdr.what(temp_path)
+        img_type = imghdr.what(None, h=image_bytes)
         if img_type not in ("jpeg", "png"):
             await update.message.reply_text(
                 "❌ Не удалось распознать растение. Попробуйте другое фото.",
@@ -154,7 +191,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # BLOCK 2: daily usage limit
-        if not await check_and_increment_limit(user_id):
+        with stage("limit_check"):
+            allowed = await check_and_increment_limit(user_id)
+        if not allowed:
             await update.message.reply_text(
                 "🚫 Лимит на сегодня исчерпан. Попробуйте завтра.",
                 parse_mode="HTML",
@@ -166,20 +205,19 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="HTML",
         )
 
-        with open(temp_path, "rb") as image_file:
-            image_bytes = image_file.read()
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.plant.id/v2/identify",
-                headers={"Api-Key": PLANT_ID_API_KEY},
-                json={
-                    "images": [image_b64],
-                    "organs": ["leaf", "flower"]
-                },
-                timeout=30
-            )
+        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+
+        with stage("plant_id"):
+            async with httpx.AsyncClient() as client:
+                response = await client.post(
+                    "https://api.plant.id/v2/identify",
+                    headers={"Api-Key": PLANT_ID_API_KEY},
+                    json={
+                        "images": [image_b64],
+                        "organs": ["leaf", "flower"]
+                    },
+                    timeout=30
+                )
 
         result = response.json()
         # BLOCK 1: probability check from Plant.id
@@ -195,22 +233,40 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"[BLOCK 1] No suggestions for user {user_id} at {datetime.utcnow().isoformat()} prob={is_plant_prob} reason=no_suggestions")
             return
 
-        top = suggestions[0]
-        name = top.get("plant_name", "неизвестно")
-        prob = round(top.get("probability", 0) * 100, 2)
-
         # BLOCK 1.2: фильтрация мусора
         if is_plant_prob >= 0.2:
-            # BLOCK 5: кнопка ухода
+            # BLOCK 5: топ-кандидаты (Plant.id + покрытие базы), кнопка ухода на каждого
+            candidates = await rank_candidates(suggestions)
+            top = candidates[0]
+            name = top["name"]
+            prob = round(top["probability"] * 100, 2)
+
+            def no_data(c: dict) -> str:
+                return " · нет в базе" if c["coverage"] == 0 else ""
+
+            lines = [f"🌱 Похоже, это: {escape(name)} ({prob}%){no_data(top)}"]
+            if len(candidates) > 1:
+                lines.append("Другие варианты:")
+                lines.extend(
+                    f"• {escape(c['name'])} ({round(c['probability'] * 100, 2)}%){no_data(c)}"
+                    for c in candidates[1:]
+                )
+
             keyboard = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🧠 Уход от BOTanika", callback_data=f"care:{name}")]]
+                [[InlineKeyboardButton("🧠 Уход от BOTanika", callback_data=care_callback_data(name))]]
+                + [
+                    [InlineKeyboardButton(f"🔎 {c['name']}", callback_data=care_callback_data(c["name"]))]
+                    for c in candidates[1:]
+                ]
             )
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text=f"🌱 Похоже, это: {name} ({prob}%)",
+                text="\n".join(lines),
                 reply_markup=keyboard,
                 parse_mode="HTML",
             )
+            # пока пользователь читает — грузим/генерируем карточку лидера в фоне
+            prefetch_card(name)
         else:
             logger.info(
                 f"[BLOCK 1.2] Low probability {is_plant_prob} for user {user_id}"
@@ -223,12 +279,14 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     except Exception as e:
         logger.error(f"[handle_photo] Ошибка: {e}\n{traceback.format_exc()}")
+        metrics.error("handle_photo")
         await update.message.reply_text(
             "Ошибка при распознавании растения.",
             parse_mode="HTML",
         )
 
 # --- Обработка кнопки «Уход»
+@profiled("main.handle_care_button")
 async def handle_care_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
 
@@ -238,17 +296,24 @@ async def handle_care_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.warning(f"[handle_care_button] query.answer() fail: {e}")
 
     try:
-        latin_name = query.data.split(":", 1)[1].strip()
+        latin_name = care_name(query.data, query.message.text if query.message else None)
+        if latin_name is None:
+            logger.info(f"[handle_care_button] unknown callback {query.data}")
+            await query.message.reply_text("⌛ Кнопка устарела — пришлите фото ещё раз.")
+            return
         # Генерация CTX-карточки (HTML) по латинскому названию
         html = await generate_card(latin_name, intent="general", lang="ru", outlen="short")
 
-        await query.message.reply_text(
-            html,
-            parse_mode="HTML",
-        )
+        # длинная карточка — несколькими сообщениями (лимит Telegram 4096)
+        for part in split_message(html):
+            await query.message.reply_text(
+                part,
+                parse_mode="HTML",
+            )
 
     except Exception as e:
         logger.error(f"[handle_care_button] Ошибка генерации карточки: {e}")
+        metrics.error("handle_care_button")
         await query.message.reply_text(
             f"❌ Не удалось сформировать карточку.\n\n{e}",
             parse_mode="HTML",
@@ -363,13 +428,22 @@ https://t.me/BOTanikPlants
 # --- Хендлеры
 application.add_handler(CommandHandler("start", start))
 application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-application.add_handler(CallbackQueryHandler(handle_care_button, pattern="^care:"))
+application.add_handler(CallbackQueryHandler(handle_care_button, pattern="^care[:#]"))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
 
 # --- Инициализация
 @app.on_event("startup")
 async def startup():
     global app_state_ready
+    # схема — отдельным шагом деплоя (python migrate.py), не на старте каждого воркера
+    try:
+        # retrieval в процессе: модель грузим здесь, а не в первых N параллельных запросах
+        await retrieval_client.warmup()
+    except Exception as e:
+        logger.error(f"[startup] Ошибка загрузки retrieval: {e}\n{traceback.format_exc()}")
+    # прогрев кэша карточек — в фоне, webhook не ждёт
+    run_in_background(warm_card_cache(), "warm_card_cache")
+    writer.start()
     try:
         await application.initialize()
         app_state_ready = True
@@ -378,6 +452,19 @@ async def startup():
     except Exception as e:
         logger.error(f"[startup] Ошибка при инициализации: {e}\n{traceback.format_exc()}")
 
+@app.on_event("shutdown")
+async def shutdown():
+    try:
+        if app_state_ready:
+            await application.shutdown()
+        # порядок важен: фоновые задачи → сброс write-behind буфера → пул
+        await cancel_background()
+        await writer.stop()
+        await close_pool()
+        await retrieval_client.close()
+    except Exception as e:
+        logger.error(f"[shutdown] Ошибка: {e}\n{traceback.format_exc()}")
+
 # --- Webhook
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
@@ -391,8 +478,43 @@ async def telegram_webhook(request: Request):
         return {"ok": True}
     except Exception as e:
         logger.error(f"[webhook] Ошибка: {e}\n{traceback.format_exc()}")
+        metrics.error("webhook")
         return {"ok": False, "error": str(e)}
 
+# --- Метрики (Prometheus)
+@app.get("/metrics")
+async def prometheus_metrics():
+    payload, content_type = metrics.render_latest()
+    return Response(content=payload, media_type=content_type)
+
+# --- Профилирование (только для админа: заголовок X-Admin-Token)
+def _require_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    token = request.headers.get("X-Admin-Token", "")
+    if not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403)
+
+@app.get("/admin/profile/stats")
+async def admin_profile_stats(request: Request):
+    _require_admin(request)
+    return {"enabled": profiling.ENABLED, "stats": profiling.stats()}
+
+@app.post("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10.0):
+    _require_admin(request)
+    logger.info(f"[PROFILE] sampling {seconds}s")
+    try:
+        # в отдельном потоке — event loop продолжает обслуживать запросы и попадает в сэмплы
+        collapsed = await asyncio.to_thread(profiling.sample, seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(
+        content=collapsed,
+        media_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'},
+    )
+
 # --- Запуск
 if __name__ == "__main__":
     import uvicorn
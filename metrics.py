@@ -0,0 +1,53 @@
+# metrics.py — Prometheus-метрики пайплайна (латентность стадий, кэш, fallback, ошибки)
+import os
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess,
+)
+
+# от быстрых стадий (кэш, MMR) до медленных (Plant.id, LLM)
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGES = (
+    "tg_download",   # get_file + download_as_bytearray
+    "plant_id",      # POST api.plant.id
+    "limit_check",   # photo_usage
+    "cache_lookup",  # gpt_cards SELECT
+    "cache_save",    # постановка карточки в write-behind буфер
+    "write_flush",   # пакетный сброс буфера в gpt_cards
+    "embed",         # SentenceTransformer.encode
+    "search",        # index.search
+    "mmr",           # сортировка + MMR-диверсификация
+    "llm",           # chat.completions
+    "render",        # Card.model_validate_json + render_html
+)
+
+STAGE_SECONDS = Histogram(
+    "helpplants_stage_seconds", "Latency of pipeline stages", ["stage"], buckets=_BUCKETS
+)
+CARD_CACHE = Counter("helpplants_card_cache_total", "Card cache lookups", ["result"])
+FALLBACKS = Counter("helpplants_fallbacks_total", "Degraded pipeline paths", ["kind"])
+ERRORS = Counter("helpplants_errors_total", "Unhandled errors by handler", ["where"])
+
+# дочерние серии создаём заранее — на горячем пути без поиска по labels
+_stage_children = {name: STAGE_SECONDS.labels(name) for name in STAGES}
+CACHE_HIT = CARD_CACHE.labels("hit")
+CACHE_MISS = CARD_CACHE.labels("miss")
+
+def stage(name: str):
+    """Таймер стадии: `with stage("llm"): ...`"""
+    return _stage_children[name].time()
+
+def fallback(kind: str) -> None:
+    FALLBACKS.labels(kind).inc()
+
+def error(where: str) -> None:
+    ERRORS.labels(where).inc()
+
+def render_latest() -> tuple[bytes, str]:
+    # несколько воркеров gunicorn: значения лежат в PROMETHEUS_MULTIPROC_DIR,
+    # любой воркер собирает сумму по всем (см. gunicorn.conf.py)
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,29 @@
+# migrate.py — применяет schema.sql к DATABASE_URL; шаг деплоя перед запуском новой версии
+#
+#   DATABASE_URL=postgresql://... python migrate.py [--lock-timeout 5s]
+#
+# На старте воркеров схема не применяется: ALTER TABLE gpt_cards берёт
+# ACCESS EXCLUSIVE даже когда колонка уже есть, и рестарт воркера во время
+# rerender_cards.py ставил бы все чтения карточек в очередь за собой.
+# Не дождались лока за --lock-timeout — ошибка, повторить позже.
+import asyncio
+import logging
+import argparse
+
+from db import apply_schema, close_pool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("migrate")
+
+async def _main(args) -> None:
+    try:
+        await apply_schema(args.lock_timeout)
+    finally:
+        await close_pool()
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Apply schema.sql to DATABASE_URL.")
+    p.add_argument("--lock-timeout", default="5s", help="Postgres lock_timeout for the DDL transaction")
+    args = p.parse_args()
+    asyncio.run(_main(args))
+    logger.info("[MIGRATE] schema.sql applied")
@@ -0,0 +1,146 @@
+# profiling.py — opt-in профилирование горячих путей (retrieval / generation)
+#
+# PROFILING=1 включает @profiled / `with profiled(...)`: wall и CPU время на вызов.
+# Без флага profiled() отдаёт no-op: декоратор возвращает исходную функцию,
+# контекст-менеджер — пустой enter/exit.
+# sample() — сэмплирующий профайлер всех потоков на N секунд в формате
+# collapsed stacks (flamegraph.pl / speedscope / inferno).
+import os
+import sys
+import time
+import asyncio
+import functools
+import threading
+from collections import Counter
+
+ENABLED = os.getenv("PROFILING", "0") == "1"
+
+SAMPLE_INTERVAL = 0.005   # 200 Гц
+MAX_SAMPLE_SECONDS = 60
+
+# name -> [calls, wall_total, cpu_total, wall_max]
+_stats: dict[str, list] = {}
+_stats_lock = threading.Lock()
+_sampling_lock = threading.Lock()
+
+def _record(name: str, wall: float, cpu: float) -> None:
+    with _stats_lock:
+        s = _stats.get(name)
+        if s is None:
+            _stats[name] = [1, wall, cpu, wall]
+        else:
+            s[0] += 1
+            s[1] += wall
+            s[2] += cpu
+            if wall > s[3]:
+                s[3] = wall
+
+class _Probe:
+    __slots__ = ("name", "_t0", "_c0")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        self._c0 = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, time.perf_counter() - self._t0, time.thread_time() - self._c0)
+        return False
+
+    def __call__(self, func):
+        name = self.name
+        if asyncio.iscoroutinefunction(func):
+            # CPU-время корутины включает чужие задачи, выполнявшиеся на том же
+            # event loop во время её await; wall — честное время ожидания
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                t0, c0 = time.perf_counter(), time.thread_time()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _record(name, time.perf_counter() - t0, time.thread_time() - c0)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0, c0 = time.perf_counter(), time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - t0, time.thread_time() - c0)
+        return wrapper
+
+class _NoopProbe:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __call__(self, func):
+        return func
+
+_NOOP = _NoopProbe()
+
+def profiled(name: str):
+    """Декоратор или контекст-менеджер: `@profiled("faiss.search")`."""
+    return _Probe(name) if ENABLED else _NOOP
+
+def stats() -> dict:
+    with _stats_lock:
+        snapshot = {k: list(v) for k, v in _stats.items()}
+    return {
+        name: {
+            "calls": calls,
+            "wall_total_ms": round(wall * 1000, 3),
+            "cpu_total_ms": round(cpu * 1000, 3),
+            "wall_avg_ms": round(wall / calls * 1000, 3),
+            "wall_max_ms": round(wall_max * 1000, 3),
+        }
+        for name, (calls, wall, cpu, wall_max) in sorted(snapshot.items())
+    }
+
+def reset() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+# =========================
+#   Сэмплирующий профайлер
+# =========================
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample(seconds: float, interval: float = SAMPLE_INTERVAL) -> str:
+    """Снимает стеки всех потоков (кроме своего) и возвращает collapsed stacks.
+
+    Блокирует вызывающий поток — из async-кода звать через asyncio.to_thread.
+    Одновременно допускается один прогон: иначе RuntimeError.
+    """
+    seconds = min(max(seconds, interval), MAX_SAMPLE_SECONDS)
+    if not _sampling_lock.acquire(blocking=False):
+        raise RuntimeError("profile already running")
+    try:
+        me = threading.get_ident()
+        counts: Counter = Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(tid, f"thread-{tid}"))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _sampling_lock.release()
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
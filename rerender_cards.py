@@ -0,0 +1,71 @@
+# rerender_cards.py — массовый перерендер gpt_cards.html из card_json (без GPT)
+#
+# После правки шаблонов в card_formatter.LAYOUTS:
+#   python rerender_cards.py [--batch 500] [--dry-run]
+# Таблица читается серверным курсором (в памяти — одна пачка), обновления
+# уходят пачками через executemany по второму соединению. Строки без
+# card_json (сохранённые до его появления) перерендерить нельзя — только
+# считаем их.
+import asyncio
+import logging
+import argparse
+
+from card_formatter import render_html
+from db import get_pool, close_pool
+from schemas import Card
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("rerender_cards")
+
+UPDATE_SQL = "UPDATE gpt_cards SET html = $3 WHERE latin_name = $1 AND intent = $2"
+
+async def rerender(batch: int = 500, dry_run: bool = False) -> dict:
+    stats = {"rows": 0, "updated": 0, "unchanged": 0, "legacy": 0, "invalid": 0}
+    pending: list[tuple[str, str, str]] = []
+
+    async def flush(writer) -> None:
+        if pending and not dry_run:
+            await writer.executemany(UPDATE_SQL, pending)
+        stats["updated"] += len(pending)
+        pending.clear()
+
+    pool = await get_pool()
+    async with pool.acquire() as reader, pool.acquire() as writer:
+        async with reader.transaction():
+            cursor = reader.cursor(
+                "SELECT latin_name, intent, html, card_json FROM gpt_cards", prefetch=batch
+            )
+            async for row in cursor:
+                stats["rows"] += 1
+                if not row["card_json"]:
+                    stats["legacy"] += 1
+                    continue
+                try:
+                    # без render_json: его lru_cache держит горячие карточки бота
+                    html = render_html(Card.model_validate_json(row["card_json"]))
+                except Exception as e:
+                    stats["invalid"] += 1
+                    logger.warning(f"[RERENDER] invalid card_json latin={row['latin_name']} intent={row['intent']}: {e}")
+                    continue
+                if html == row["html"]:
+                    stats["unchanged"] += 1
+                    continue
+                pending.append((row["latin_name"], row["intent"], html))
+                if len(pending) >= batch:
+                    await flush(writer)
+            await flush(writer)
+    return stats
+
+async def _main(args) -> dict:
+    try:
+        return await rerender(args.batch, args.dry_run)
+    finally:
+        await close_pool()
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Re-render gpt_cards.html from the stored card JSON.")
+    p.add_argument("--batch", type=int, default=500, help="rows per cursor fetch and per UPDATE batch")
+    p.add_argument("--dry-run", action="store_true", help="count changes without writing")
+    args = p.parse_args()
+    stats = asyncio.run(_main(args))
+    logger.info(f"[RERENDER] {'dry-run ' if args.dry_run else ''}" + " ".join(f"{k}={v}" for k, v in stats.items()))
@@ -0,0 +1,67 @@
+# retrieval_client.py — async-клиент retrieval-сервиса (retrieval_server.py)
+#
+# RETRIEVAL_SOCKET=/tmp/helpplants-retrieval.sock или RETRIEVAL_URL=http://127.0.0.1:8090
+# — ходим в сервис одним переиспользуемым httpx.AsyncClient (keep-alive).
+# Ни то ни другое не задано — faiss_search в этом же процессе (как раньше),
+# но в отдельном потоке, чтобы encode не блокировал event loop; импорт
+# faiss_search (torch) и загрузка модели — тоже в потоке, см. warmup().
+import os
+import asyncio
+from typing import Dict, List, Optional
+
+import httpx
+
+RETRIEVAL_SOCKET = os.getenv("RETRIEVAL_SOCKET")
+RETRIEVAL_URL = os.getenv("RETRIEVAL_URL")
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "30"))
+REMOTE = bool(RETRIEVAL_SOCKET or RETRIEVAL_URL)
+
+_client: httpx.AsyncClient | None = None
+
+def _get_client() -> httpx.AsyncClient:
+    """Лениво — уже в воркере, после fork."""
+    global _client
+    if _client is None:
+        if RETRIEVAL_SOCKET:
+            transport = httpx.AsyncHTTPTransport(uds=RETRIEVAL_SOCKET, retries=1)
+            base_url = "http://retrieval"
+        else:
+            transport = httpx.AsyncHTTPTransport(retries=1)
+            base_url = RETRIEVAL_URL
+        _client = httpx.AsyncClient(transport=transport, base_url=base_url, timeout=RETRIEVAL_TIMEOUT)
+    return _client
+
+def _local_search(queries: List[tuple]) -> List[List[Dict]]:
+    import faiss_search
+    return faiss_search.search_batch(queries)
+
+def _local_warmup() -> None:
+    import faiss_search
+    faiss_search.warmup()
+
+async def warmup() -> None:
+    """Без сервиса — грузит индекс и энкодер в этот процесс до первых запросов
+    (при gunicorn PRELOAD_MODELS=1 уже загружены в master — мгновенно)."""
+    if not REMOTE:
+        await asyncio.to_thread(_local_warmup)
+
+async def search_batch(queries: List[tuple]) -> List[List[Dict]]:
+    """[(latin_name, intent, top_k)] -> список чанков на каждый запрос, в том же порядке."""
+    if not REMOTE:
+        return await asyncio.to_thread(_local_search, queries)
+
+    rsp = await _get_client().post(
+        "/search/batch",
+        json={"queries": [{"latin_name": l, "intent": i, "top_k": k} for l, i, k in queries]},
+    )
+    rsp.raise_for_status()
+    return rsp.json()["results"]
+
+async def get_chunks(latin_name: str, top_k: int = 12, intent: Optional[str] = None) -> List[Dict]:
+    return (await search_batch([(latin_name, intent, top_k)]))[0]
+
+async def close() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
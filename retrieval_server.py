@@ -0,0 +1,115 @@
+# retrieval_server.py — FAISS retrieval как отдельный локальный сервис
+#
+#   uvicorn retrieval_server:app --uds /tmp/helpplants-retrieval.sock
+#   # или: python retrieval_server.py  (RETRIEVAL_SOCKET / RETRIEVAL_PORT)
+#
+# Энкодер и индекс живут только здесь; бот (и другие инструменты) ходят через
+# retrieval_client.py. Запросы от всех клиентов копятся до BATCH_MAX_SIZE штук
+# или BATCH_MAX_WAIT_MS и уходят в faiss_search.search_batch одним encode/search.
+import os
+import asyncio
+import logging
+
+from fastapi import FastAPI, Response
+
+import faiss_search
+import metrics
+from schemas import BatchSearchRequest
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_SOCKET = os.getenv("RETRIEVAL_SOCKET", "/tmp/helpplants-retrieval.sock")
+RETRIEVAL_PORT = os.getenv("RETRIEVAL_PORT")  # если задан — TCP 127.0.0.1 вместо сокета
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "64"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+class MicroBatcher:
+    """Склеивает одиночные запросы в пачки для faiss_search.search_batch."""
+
+    def __init__(self, max_size: int, max_wait_ms: float) -> None:
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, query: tuple) -> list[dict]:
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [q for q, _ in batch]
+            try:
+                # encode/search отпускают GIL — event loop тем временем копит следующую пачку
+                results = await asyncio.to_thread(faiss_search.search_batch, queries)
+            except Exception as e:
+                logger.error(f"[RETRIEVAL] batch of {len(batch)} failed: {e}")
+                metrics.error("retrieval_batch")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(res)
+
+app = FastAPI()
+batcher = MicroBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+@app.on_event("startup")
+async def startup():
+    await asyncio.to_thread(faiss_search.warmup)
+    batcher.start()
+    logger.info(f"[RETRIEVAL] ready batch_max={BATCH_MAX_SIZE} wait_ms={BATCH_MAX_WAIT_MS}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    await batcher.stop()
+
+@app.get("/health")
+async def health():
+    return {"ok": True}
+
+@app.post("/search/batch")
+async def search_batch(req: BatchSearchRequest):
+    results = await asyncio.gather(
+        *(batcher.submit((q.latin_name, q.intent, q.top_k)) for q in req.queries)
+    )
+    return {"results": results}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    payload, content_type = metrics.render_latest()
+    return Response(content=payload, media_type=content_type)
+
+if __name__ == "__main__":
+    import uvicorn
+    logging.basicConfig(level=logging.INFO)
+    if RETRIEVAL_PORT:
+        uvicorn.run("retrieval_server:app", host="127.0.0.1", port=int(RETRIEVAL_PORT))
+    else:
+        uvicorn.run("retrieval_server:app", uds=RETRIEVAL_SOCKET)
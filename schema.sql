@@ -0,0 +1,34 @@
+-- schema.sql — таблицы, которые ожидают limit_checker.py и service.py
+-- Применяется отдельным шагом деплоя (python migrate.py) и loadtest.py --init-db,
+-- не при старте бота; только идемпотентные CREATE/ALTER ... IF NOT EXISTS.
+
+CREATE TABLE IF NOT EXISTS photo_usage (
+    user_id BIGINT NOT NULL,
+    date    DATE   NOT NULL,
+    count   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, date)
+);
+
+-- BLOCK 1: пауза между распознаваниями (RATE_LIMIT_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS photo_rate_limit (
+    user_id BIGINT PRIMARY KEY,
+    last_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS gpt_cards (
+    latin_name TEXT NOT NULL,
+    intent     TEXT NOT NULL DEFAULT 'general',
+    html       TEXT,
+    source     TEXT,
+    text       TEXT,  -- legacy (get_card_by_latin_name / save_card)
+    PRIMARY KEY (latin_name, intent)
+);
+
+-- валидированный Card (schemas.py); html перерисовывается из него без GPT
+ALTER TABLE gpt_cards ADD COLUMN IF NOT EXISTS card_json JSONB;
+
+-- число обращений к карточке: прогрев кэша при старте берёт топ по hits.
+-- Без индекса: hits растёт на каждой выдаче, индекс по нему отключил бы HOT-update,
+-- а единственный читатель — один ORDER BY hits LIMIT N при старте (seq scan дёшев).
+ALTER TABLE gpt_cards ADD COLUMN IF NOT EXISTS hits BIGINT NOT NULL DEFAULT 0;
+DROP INDEX IF EXISTS gpt_cards_hits_idx;
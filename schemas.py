@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, HttpUrl, constr, conlist
-from typing import List
+from typing import List, Optional
 
 class Card(BaseModel):
     title: constr(strip_whitespace=True, min_length=2, max_length=120)
@@ -10,3 +10,12 @@ class Card(BaseModel):
 
     class Config:
         extra = "ignore"  # игнорировать лишние поля
+
+# --- Retrieval-сервис (retrieval_server.py / retrieval_client.py)
+class RetrievalQuery(BaseModel):
+    latin_name: constr(strip_whitespace=True, min_length=1, max_length=200)
+    intent: Optional[str] = None
+    top_k: int = Field(12, ge=1, le=50)
+
+class BatchSearchRequest(BaseModel):
+    queries: conlist(RetrievalQuery, min_length=1, max_length=256)
@@ -1,9 +1,10 @@
 # service.py
 import os
 import json
+import asyncio
 import logging
 import aiohttp
-from urllib.parse import urlparse
+from collections import OrderedDict
 
 # --- Логи
 logger = logging.getLogger(__name__)
@@ -18,9 +19,12 @@ HEADERS = {
 # --- OpenAI / CTX / Retrieval / Render
 from openai import AsyncOpenAI
 from ctx_packet import make_ctx
-from faiss_search import get_chunks_by_latin_name  # filter_by_intent больше не нужен
-from card_formatter import render_html
+from retrieval_client import get_chunks, search_batch  # FAISS: retrieval-сервис или in-process
+from card_formatter import render_html, render_json, render_chunks
 from schemas import Card
+from metrics import stage, fallback, CACHE_HIT, CACHE_MISS
+from profiling import profiled
+from write_behind import writer, UPSERT_CARD_SQL
 
 K = 12
 FACTS_USED = 6
@@ -62,31 +66,7 @@ async def identify_plant(image_path: str) -> dict:
 # =========================
 #   PostgreSQL (asyncpg)
 # =========================
-import asyncpg
-
-DATABASE_URL = os.getenv("DATABASE_URL")
-parsed = urlparse(DATABASE_URL) if DATABASE_URL else None
-
-PG_USER = parsed.username if parsed else None
-PG_PASSWORD = parsed.password if parsed else None
-PG_HOST = parsed.hostname if parsed else None
-PG_PORT = parsed.port if parsed else None
-PG_DB = parsed.path[1:] if parsed and parsed.path.startswith('/') else None
-
-_pool = None
-
-async def get_pool():
-    """Возвращает кэшированный пул соединений asyncpg."""
-    global _pool
-    if _pool is None:
-        _pool = await asyncpg.create_pool(
-            host=PG_HOST,
-            port=PG_PORT,
-            user=PG_USER,
-            password=PG_PASSWORD,
-            database=PG_DB,
-        )
-    return _pool
+from db import get_pool
 
 # --- Legacy совместимость (не используется CTX-пайплайном)
 async def get_card_by_latin_name(latin_name: str) -> dict | None:
@@ -109,25 +89,215 @@ async def save_card(data: dict):
         """
         await conn.execute(query, data.get("latin_name"), data.get("text"))
 
-# --- Кэш по (latin_name, intent) и html
+# --- Кэш по (latin_name, intent): card_json (источник истины) + html (готовый рендер)
+def _row_html(row) -> str | None:
+    """Есть JSON — рендерим актуальным шаблоном (мемоизировано), старые строки — как есть.
+
+    JSON, не прошедший валидацию (схема Card с тех пор ужесточилась), — тоже как есть.
+    """
+    if row["card_json"]:
+        try:
+            return render_json(row["card_json"], "html")
+        except ValueError as e:  # pydantic.ValidationError
+            logger.warning(f"[CACHE] invalid card_json latin={row['latin_name']} intent={row['intent']}: {e}")
+            fallback("card_json_invalid")
+    return row["html"]
+
+@profiled("pg.get_card_by_latin_intent")
 async def get_card_by_latin_intent(latin_name: str, intent: str = "general") -> str | None:
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT html FROM gpt_cards WHERE latin_name=$1 AND intent=$2",
+            "SELECT latin_name, intent, html, card_json FROM gpt_cards WHERE latin_name=$1 AND intent=$2",
+            latin_name, intent
+        )
+    if not row:
+        return None
+    return _row_html(row)
+
+async def get_card_json_by_latin_intent(latin_name: str, intent: str = "general") -> str | None:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            "SELECT card_json FROM gpt_cards WHERE latin_name=$1 AND intent=$2",
             latin_name, intent
         )
-        return row["html"] if row else None
 
-async def save_card_html(latin_name: str, intent: str, html: str, source: str = "RAG"):
+async def render_card(latin_name: str, intent: str = "general", fmt: str = "html") -> tuple[str, ...] | None:
+    """Карточка в формате fmt (html / text), порезанная на сообщения Telegram; без GPT."""
+    card_json = await get_card_json_by_latin_intent(latin_name, intent)
+    if not card_json:
+        return None
+    try:
+        return render_chunks(card_json, fmt)
+    except ValueError as e:  # pydantic.ValidationError: в другом формате без JSON не отрисовать
+        logger.warning(f"[CACHE] invalid card_json latin={latin_name} intent={intent}: {e}")
+        fallback("card_json_invalid")
+        return None
+
+@profiled("pg.save_card_html")
+async def save_card_html(latin_name: str, intent: str, html: str, source: str = "RAG",
+                         card_json: str | None = None):
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(UPSERT_CARD_SQL, latin_name, intent, html, source, card_json)
+
+# =========================
+#   In-process кэш карточек (LRU поверх gpt_cards)
+# =========================
+NO_DATA = "Недостаточно данных"
+
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "2000"))
+WARM_CARDS = int(os.getenv("WARM_CARDS", "500"))          # сколько топ-карточек грузить при старте
+# off | load | generate. load — только gpt_cards → кэш. generate — ещё и GPT для
+# лидера на каждое распознанное фото, даже если кнопку не нажмут: на холодном
+# кэше это ~1 вызов LLM на фото, поэтому только явно
+CARD_PREFETCH = os.getenv("CARD_PREFETCH", "load")
+
+_card_cache: "OrderedDict[tuple[str, str], str]" = OrderedDict()  # (latin, intent) -> html
+_inflight: dict[tuple[str, str], asyncio.Task] = {}
+_background: set[asyncio.Task] = set()
+
+def _cache_get(key: tuple[str, str]) -> str | None:
+    html = _card_cache.get(key)
+    if html is not None:
+        _card_cache.move_to_end(key)
+    return html
+
+def _cache_put(key: tuple[str, str], html: str) -> None:
+    _card_cache[key] = html
+    _card_cache.move_to_end(key)
+    while len(_card_cache) > CARD_CACHE_SIZE:
+        _card_cache.popitem(last=False)
+
+def run_in_background(coro, what: str) -> asyncio.Task:
+    """Фоновая задача со ссылкой (иначе GC может её собрать) и логом ошибок."""
+    async def _guarded():
+        try:
+            return await coro
+        except Exception as e:
+            logger.warning(f"[BG] {what} failed: {e}")
+    task = asyncio.create_task(_guarded())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+async def cancel_background() -> None:
+    """На shutdown: prefetch/прогрев больше не нужны, их записи не должны опоздать к сбросу буфера.
+
+    Генерация prefetch идёт в задаче _single_flight под asyncio.shield — отмена
+    обёртки её не останавливает, поэтому отменяем и задачи из _inflight.
+    """
+    tasks = list(_background) + list(_inflight.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _single_flight(key: tuple[str, str], factory):
+    """Один запрос на ключ: повторные вызовы ждут уже идущую загрузку/генерацию."""
+    task = _inflight.get(key)
+    if task is None or task.done():
+        task = asyncio.create_task(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None) if _inflight.get(key) is t else None)
+    return await asyncio.shield(task)
+
+async def warm_card_cache(limit: int = WARM_CARDS) -> int:
+    """Стримит топ-`limit` карточек gpt_cards (по hits) курсором в in-process кэш."""
+    limit = min(limit, CARD_CACHE_SIZE)
+    if limit <= 0:
+        return 0
+    loaded = 0
     pool = await get_pool()
     async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO gpt_cards (latin_name, intent, html, source)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (latin_name, intent)
-            DO UPDATE SET html = EXCLUDED.html, source = EXCLUDED.source
-        """, latin_name, intent, html, source)
+        async with conn.transaction():
+            cursor = conn.cursor(
+                "SELECT latin_name, intent, html, card_json FROM gpt_cards "
+                "ORDER BY hits DESC LIMIT $1",
+                limit, prefetch=200,
+            )
+            async for row in cursor:
+                html = _row_html(row)
+                if not html:
+                    continue
+                key = (row["latin_name"], row["intent"])
+                # самые популярные идут первыми — не затираем то, что уже успели положить запросы
+                if key not in _card_cache:
+                    _card_cache[key] = html
+                    _card_cache.move_to_end(key, last=False)
+                loaded += 1
+    # пока шёл прогрев, запросы тоже клали карточки — вытесняем сверх лимита
+    # (с начала — это самые холодные из прогретых)
+    while len(_card_cache) > CARD_CACHE_SIZE:
+        _card_cache.popitem(last=False)
+    logger.info(f"[CACHE] warm loaded={loaded} limit={limit}")
+    return loaded
+
+def prefetch_card(latin_name: str, intent: str = "general") -> None:
+    """Предзагрузка карточки, пока пользователь читает результат распознавания."""
+    if CARD_PREFETCH == "off":
+        return
+    key = (latin_name, intent)
+    if key in _card_cache or key in _inflight:
+        return
+    generate = CARD_PREFETCH == "generate"
+    logger.info(f"[PREFETCH] latin={latin_name} intent={intent} mode={CARD_PREFETCH}")
+    run_in_background(
+        _single_flight(key, lambda: _load_or_generate(latin_name, intent, generate=generate)),
+        f"prefetch {latin_name}",
+    )
+
+# =========================
+#   Кандидаты Plant.id: пакетный retrieval + ранжирование по покрытию базы
+# =========================
+TOP_CANDIDATES = 3
+FACTS_CACHE_SIZE = int(os.getenv("FACTS_CACHE_SIZE", "512"))
+PROB_WEIGHT = 0.7       # вес вероятности Plant.id
+COVERAGE_WEIGHT = 0.3   # вес покрытия в clean_chunks
+
+# (latin, intent) -> чанки retrieval; generate_card берёт отсюда вместо повторного поиска
+_facts_cache: "OrderedDict[tuple[str, str], list[dict]]" = OrderedDict()
+
+def _facts_put(key: tuple[str, str], chunks: list[dict]) -> None:
+    _facts_cache[key] = chunks
+    _facts_cache.move_to_end(key)
+    while len(_facts_cache) > FACTS_CACHE_SIZE:
+        _facts_cache.popitem(last=False)
+
+def _coverage(chunks: list[dict]) -> float:
+    """0..1: сколько фактов для карточки найдено по виду (по роду — вполовину)."""
+    species = sum(1 for c in chunks if c.get("match") == "species")
+    genus = sum(1 for c in chunks if c.get("match") == "genus")
+    return min(1.0, (species + 0.5 * genus) / FACTS_USED)
+
+async def rank_candidates(suggestions: list[dict], intent: str = "general") -> list[dict]:
+    """Топ-кандидаты Plant.id с покрытием нашей базы, по убыванию общего score.
+
+    Retrieval для всех кандидатов — один пакетный запрос; факты кладутся в
+    _facts_cache, так что карточка по любой кнопке не ищет заново.
+    """
+    candidates = [
+        {"name": s.get("plant_name", "неизвестно"), "probability": float(s.get("probability", 0))}
+        for s in suggestions[:TOP_CANDIDATES]
+    ]
+    intent_for_rag = None if intent == "general" else intent
+    try:
+        results = await search_batch([(c["name"], intent_for_rag, K) for c in candidates])
+    except Exception as e:
+        # без retrieval — порядок Plant.id, покрытие неизвестно
+        logger.warning(f"[RANK] retrieval failed, keeping Plant.id order: {e}")
+        fallback("rank_retrieval")
+        return [dict(c, coverage=None, score=c["probability"]) for c in candidates]
+
+    for c, chunks in zip(candidates, results):
+        _facts_put((c["name"], intent), chunks)
+        c["coverage"] = _coverage(chunks)
+        c["score"] = PROB_WEIGHT * c["probability"] + COVERAGE_WEIGHT * c["coverage"]
+    candidates.sort(key=lambda c: c["score"], reverse=True)
+    logger.info("[RANK] " + " ".join(
+        f"{c['name']}:p={c['probability']:.2f},cov={c['coverage']:.2f}" for c in candidates
+    ))
+    return candidates
 
 # =========================
 #   Маппинг имён (оставляем)
@@ -148,22 +318,56 @@ def map_latin_to_russian(latin_name: str) -> str:
 # =========================
 #   CTX-карточка (FAISS → GPT(JSON) → HTML → Cache)
 # =========================
+@profiled("service.generate_card")
 async def generate_card(latin_name: str, intent: str = "general", lang: str = "ru", outlen: str = "short") -> str:
+    key = (latin_name, intent)
+
+    # 0) In-process кэш
+    html = _cache_get(key)
+    if html is not None:
+        CACHE_HIT.inc()
+        logger.info(f"[CACHE] hit (memory) latin={latin_name} intent={intent}")
+    else:
+        factory = lambda: _load_or_generate(latin_name, intent, lang, outlen)
+        html, from_db = await _single_flight(key, factory)
+        if html is None:
+            # присоединились к prefetch в режиме load, а в gpt_cards карточки нет
+            html, from_db = await _single_flight(key, factory)
+        # hit/miss считаем здесь, на пути пользователя: prefetch того же ключа не в счёт
+        (CACHE_HIT if from_db else CACHE_MISS).inc()
+
+    # считаем только выданные карточки: строка уже в gpt_cards или раньше в том же буфере
+    if html != NO_DATA:
+        writer.add_hits(latin_name, intent)
+    return html
+
+async def _load_or_generate(latin_name: str, intent: str = "general", lang: str = "ru",
+                            outlen: str = "short", generate: bool = True) -> tuple[str | None, bool]:
+    """(html, найдена ли в gpt_cards); html None — не найдена, а generate=False."""
+    key = (latin_name, intent)
+
     # 1) Кэш
-    cached = await get_card_by_latin_intent(latin_name, intent)
+    with stage("cache_lookup"):
+        cached = await get_card_by_latin_intent(latin_name, intent)
     if cached:
         logger.info(f"[CACHE] hit latin={latin_name} intent={intent}")
-        return cached
+        _cache_put(key, cached)
+        return cached, True
+    if not generate:
+        return None, False
 
     # 2) Retrieval (intent прокидываем внутрь; для general — None)
     intent_for_rag = None if intent == "general" else intent
-    chunks = get_chunks_by_latin_name(latin_name, top_k=K, intent=intent_for_rag)
+    chunks = _facts_cache.get(key)
+    if chunks is None:
+        chunks = await get_chunks(latin_name, top_k=K, intent=intent_for_rag)
     facts = [c["text"][:CLIP] for c in chunks][:FACTS_USED]
 
     if not facts:
         logger.warning(f"[RAG] No facts latin={latin_name}")
+        fallback("no_facts")
         # Без HTML-тегов — чтобы Telegram не ругался
-        return "Недостаточно данных"
+        return NO_DATA, False
 
     # 3) CTX + строгий формат
     ctx = make_ctx(latin_name, intent, lang, outlen)
@@ -174,22 +378,28 @@ async def generate_card(latin_name: str, intent: str = "general", lang: str = "r
     )
 
     # 4) GPT(JSON)
-    rsp = await client.chat.completions.create(
-        model=MODEL,
-        temperature=TEMP,
-        response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": sys_msg},
-            {"role": "user", "content": usr_msg}
-        ]
-    )
+    with stage("llm"):
+        rsp = await client.chat.completions.create(
+            model=MODEL,
+            temperature=TEMP,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": sys_msg},
+                {"role": "user", "content": usr_msg}
+            ]
+        )
 
     # 5) Валидация JSON → HTML
-    card = Card.model_validate_json(rsp.choices[0].message.content)
-    html = render_html(card)
+    with stage("render"):
+        with profiled("service.validate"):
+            card = Card.model_validate_json(rsp.choices[0].message.content)
+        card_json = card.model_dump_json()
+        html = render_html(card)
 
-    # 6) Кэш + метрики
-    await save_card_html(latin_name, intent, html, source="RAG")
+    # 6) Кэш (валидированный JSON + HTML) + метрики; запись в gpt_cards — write-behind
+    with stage("cache_save"):
+        writer.enqueue_card(latin_name, intent, html, source="RAG", card_json=card_json)
+    _cache_put(key, html)
 
     usage = getattr(rsp, "usage", None)
     try:
@@ -201,4 +411,4 @@ async def generate_card(latin_name: str, intent: str = "general", lang: str = "r
     except Exception:
         pass
 
-    return html
+    return html, False
@@ -0,0 +1,26 @@
+import re
+
+import pytest
+
+from card_formatter import split_message
+
+def _broken(part: str) -> bool:
+    # оборванная сущность или тег в конце / начале части
+    return bool(re.search(r"&[#\w]*$", part) or re.match(r"^[#\w]*;", part)) or part.rfind("<") > part.rfind(">")
+
+@pytest.mark.parametrize("text", [
+    "&amp;" * 1000,
+    "слово " * 1500,
+    "a &lt; b " * 30 + "x" * 5000,
+    "<b>Ficus</b>\n\n" + "&quot;полив&quot; " * 600,
+])
+def test_split_message_keeps_entities_and_tags_whole(text):
+    parts = split_message(text)
+    assert len(parts) > 1
+    assert all(len(p) <= 4096 for p in parts)
+    assert not any(_broken(p) for p in parts)
+
+def test_split_message_prefers_spaces():
+    parts = split_message("слово " * 1500)
+    assert all(p.endswith(" ") for p in parts[:-1])
+    assert "".join(parts) == "слово " * 1500
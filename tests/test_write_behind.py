@@ -0,0 +1,205 @@
+# Write-behind без Postgres: fake-пул за write_behind.get_pool, применяет
+# пачку только на COMMIT — как настоящая транзакция.
+import asyncio
+from collections import Counter
+
+import asyncpg
+import pytest
+
+import write_behind
+from write_behind import WriteBehind, UPSERT_CARD_SQL, INCREMENT_HITS_SQL
+
+class FakeDB:
+    def __init__(self, delay: float = 0.0, commit_delay: float = 0.0, fail: int = 0):
+        self.cards: dict = {}
+        self.hits: Counter = Counter()
+        self.commits = 0
+        self.delay = delay                  # пауза внутри executemany — окно для stop()
+        self.commit_delay = commit_delay    # COMMIT уже применён, ответ сервера ещё в пути
+        self.fail = fail                    # сколько первых executemany упадут
+        self.in_flush = asyncio.Event()
+        self.committed = asyncio.Event()
+        self.calls = 0
+
+    def acquire(self):
+        return _Ctx(_FakeConn(self))
+
+class _Ctx:
+    def __init__(self, value):
+        self.value = value
+
+    async def __aenter__(self):
+        return self.value
+
+    async def __aexit__(self, *exc):
+        return False
+
+class _FakeConn:
+    def __init__(self, db: FakeDB):
+        self.db = db
+        self.pending: list = []
+
+    def transaction(self):
+        conn = self
+
+        class _Tx:
+            async def __aenter__(self):
+                conn.pending = []
+
+            async def __aexit__(self, exc_type, *exc):
+                if exc_type is None:
+                    conn.apply()
+                    conn.db.committed.set()
+                    if conn.db.commit_delay:
+                        await asyncio.sleep(conn.db.commit_delay)
+                return False
+        return _Tx()
+
+    async def executemany(self, sql, rows):
+        self.db.in_flush.set()
+        self.db.calls += 1
+        if self.db.delay:
+            await asyncio.sleep(self.db.delay)
+        if self.db.fail:
+            self.db.fail -= 1
+            raise ConnectionError("connection reset")
+        rows = list(rows)
+        # TEXT/JSONB не принимают NUL — вся пачка падает, как на сервере
+        if any("\x00" in str(v) for row in rows for v in row):
+            raise asyncpg.CharacterNotInRepertoireError('invalid byte sequence for encoding "UTF8": 0x00')
+        self.pending.append((sql, rows))
+
+    def apply(self):
+        for sql, rows in self.pending:
+            for row in rows:
+                if sql == UPSERT_CARD_SQL:
+                    latin, intent, html, source, card_json = row
+                    self.db.cards[(latin, intent)] = html
+                elif sql == INCREMENT_HITS_SQL:
+                    latin, intent, n = row
+                    if (latin, intent) in self.db.cards:
+                        self.db.hits[(latin, intent)] += n
+        self.db.commits += 1
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDB()
+
+    async def get_pool():
+        return fake
+    monkeypatch.setattr(write_behind, "get_pool", get_pool)
+    return fake
+
+def _fill(w: WriteBehind, names, hits_each: int = 3) -> None:
+    for name in names:
+        w.enqueue_card(name, "general", f"<b>{name}</b>")
+        for _ in range(hits_each):
+            w.add_hits(name, "general")
+
+def test_stop_flushes_everything_once(db):
+    async def scenario():
+        w = WriteBehind(max_batch=10_000, interval_ms=60_000)
+        _fill(w, [f"Plant {i}" for i in range(50)])
+        await w.stop()
+        assert len(w) == 0
+
+    asyncio.run(scenario())
+    assert len(db.cards) == 50
+    assert set(db.hits.values()) == {3}
+
+@pytest.mark.parametrize("phase", ["executemany", "commit"])
+def test_restart_loses_and_duplicates_nothing(db, phase):
+    db.delay = db.commit_delay = 0.05
+    names = [f"Plant {i}" for i in range(20)]
+
+    async def scenario():
+        first = WriteBehind(max_batch=5, interval_ms=60_000)
+        _fill(first, names)
+        # stop() приходит, пока фоновый цикл внутри executemany / ждёт ответа на COMMIT
+        await (db.in_flush if phase == "executemany" else db.committed).wait()
+        _fill(first, ["Late plant"], hits_each=2)
+        await first.stop()
+        assert len(first) == 0
+
+        second = WriteBehind(max_batch=5, interval_ms=60_000)
+        for name in names:
+            second.add_hits(name, "general")
+        await second.stop()
+
+    asyncio.run(scenario())
+    assert set(db.cards) == {(n, "general") for n in names + ["Late plant"]}
+    assert all(db.hits[(n, "general")] == 4 for n in names)
+    assert db.hits[("Late plant", "general")] == 2
+
+def test_failed_flush_is_retried_without_double_count(db):
+    db.fail = 1
+
+    async def scenario():
+        w = WriteBehind(max_batch=10_000, interval_ms=10)
+        _fill(w, ["Ficus elastica"])
+        while not db.commits:
+            await asyncio.sleep(0.01)
+        await w.stop()
+
+    asyncio.run(scenario())
+    assert db.hits[("Ficus elastica", "general")] == 3
+
+def test_writes_after_stop_are_refused(db):
+    async def scenario():
+        w = WriteBehind(max_batch=10_000, interval_ms=60_000)
+        _fill(w, ["Monstera deliciosa"], hits_each=1)
+        await w.stop()
+        w.enqueue_card("Too late", "general", "x")
+        w.add_hits("Monstera deliciosa", "general")
+        # новый цикл не поднимается, буфер пуст
+        assert w._task is None and len(w) == 0
+
+    asyncio.run(scenario())
+    assert ("Too late", "general") not in db.cards
+    assert db.hits[("Monstera deliciosa", "general")] == 1
+
+def test_poison_row_is_dropped_and_does_not_block_the_rest(db):
+    names = [f"Plant {i}" for i in range(40)]
+
+    async def scenario():
+        w = WriteBehind(max_batch=10_000, interval_ms=60_000)
+        _fill(w, names[:20])
+        w.enqueue_card("Bad plant", "general", "<b>broken\x00</b>")
+        w.add_hits("Bad plant", "general")
+        _fill(w, names[20:])
+        assert await w.flush() == len(names) * 2 + 1  # кроме карточки с NUL
+        assert len(w) == 0
+        await w.stop()
+
+    asyncio.run(scenario())
+    assert set(db.cards) == {(n, "general") for n in names}
+    assert all(db.hits[(n, "general")] == 3 for n in names)
+    # деление пополам, а не по одной записи
+    assert db.calls < len(names) * 2
+
+def test_transient_failures_are_retried_a_bounded_number_of_times(db):
+    db.fail = 10**6
+
+    async def scenario():
+        w = WriteBehind(max_batch=10_000, interval_ms=60_000, max_retries=3)
+        _fill(w, ["Ficus elastica"], hits_each=1)
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                await w.flush()
+        assert len(w) == 0
+
+    asyncio.run(scenario())
+    assert not db.cards
+
+def test_buffer_is_capped(db):
+    async def scenario():
+        w = WriteBehind(max_batch=10_000, interval_ms=60_000, max_pending=5)
+        for i in range(10):
+            w.enqueue_card(f"Plant {i}", "general", "x")
+        # уже известный ключ обновляется и при полном буфере
+        w.enqueue_card("Plant 0", "general", "fresh")
+        assert len(w) == 5
+        await w.stop()
+
+    asyncio.run(scenario())
+    assert len(db.cards) == 5 and db.cards[("Plant 0", "general")] == "fresh"
@@ -0,0 +1,227 @@
+# write_behind.py — отложенная пакетная запись в gpt_cards (карточки + счётчики hits)
+#
+# Хендлеры только кладут запись в буфер; фоновая задача сбрасывает его
+# пачкой (executemany) раз в WRITE_BEHIND_INTERVAL_MS или при
+# WRITE_BEHIND_MAX_BATCH записях. stop() дожидается последнего сброса —
+# вызывается из shutdown приложения до закрытия пула. Текущий сброс stop()
+# не отменяет: отмена после COMMIT вернула бы уже записанные hits в буфер
+# (двойной счёт), а отменённый запрос asyncpg портит соединение.
+#
+# Ошибки сброса:
+# - данные (DataError / нарушение ограничения, напр. \u0000 из ответа LLM) —
+#   пачка делится пополам до отдельной записи, эта запись отбрасывается;
+# - остальное (соединение, таймаут) — пачка возвращается в буфер, повтор
+#   с экспоненциальной паузой; запись, не прошедшая WRITE_BEHIND_MAX_RETRIES
+#   сбросов подряд, отбрасывается. Буфер ограничен WRITE_BEHIND_MAX_PENDING
+#   ключами — новые ключи сверх него отбрасываются, уже известные обновляются.
+#
+# photo_usage сюда не попадает: дневной лимит читается и пишется в одной
+# транзакции пользовательского запроса, отложить её нельзя.
+import os
+import asyncio
+import logging
+from collections import Counter, deque
+
+import asyncpg
+
+from db import get_pool
+from metrics import stage, error
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200"))
+WRITE_BEHIND_INTERVAL_MS = float(os.getenv("WRITE_BEHIND_INTERVAL_MS", "1000"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "20000"))
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "8"))
+MAX_BACKOFF_SECONDS = 60.0
+
+UPSERT_CARD_SQL = """
+    INSERT INTO gpt_cards (latin_name, intent, html, source, card_json)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (latin_name, intent)
+    DO UPDATE SET html = EXCLUDED.html, source = EXCLUDED.source, card_json = EXCLUDED.card_json
+"""
+INCREMENT_HITS_SQL = "UPDATE gpt_cards SET hits = hits + $3 WHERE latin_name=$1 AND intent=$2"
+
+def _is_data_error(e: BaseException) -> bool:
+    """Ошибка, которую повтор той же записи не исправит.
+
+    ValueError — клиентские ошибки кодирования аргументов asyncpg.
+    """
+    return isinstance(e, (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, ValueError))
+
+class WriteBehind:
+    def __init__(self, max_batch: int = WRITE_BEHIND_MAX_BATCH,
+                 interval_ms: float = WRITE_BEHIND_INTERVAL_MS,
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING,
+                 max_retries: int = WRITE_BEHIND_MAX_RETRIES) -> None:
+        self.max_batch = max_batch
+        self.interval = interval_ms / 1000.0
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        # последняя версия карточки на ключ — повторные upsert'ы схлопываются
+        self._cards: dict[tuple[str, str], tuple[str, str, str | None]] = {}
+        self._hits: Counter = Counter()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._stopped = False
+        # ("card"|"hits", key) -> сколько сбросов подряд запись не прошла
+        self._attempts: Counter = Counter()
+        self._failures = 0  # неудачные сбросы подряд — для паузы в _run
+        self._overflowed = False
+
+    def __len__(self) -> int:
+        return len(self._cards) + len(self._hits)
+
+    # --- API для хендлеров (не ждут БД)
+    def enqueue_card(self, latin_name: str, intent: str, html: str, source: str = "RAG",
+                     card_json: str | None = None) -> None:
+        key = (latin_name, intent)
+        if self._refuse("card", latin_name, intent) or self._full("card", key, self._cards):
+            return
+        self._cards[key] = (html, source, card_json)
+        self._kick()
+
+    def add_hits(self, latin_name: str, intent: str, n: int = 1) -> None:
+        key = (latin_name, intent)
+        if self._refuse("hits", latin_name, intent) or self._full("hits", key, self._hits):
+            return
+        self._hits[key] += n
+        self._kick()
+
+    def _refuse(self, kind: str, latin_name: str, intent: str) -> bool:
+        # после stop() финальный сброс уже прошёл, а пул закрыт — запись потерялась бы молча
+        if self._stopped:
+            error("write_after_stop")
+            logger.error(f"[WRITE] {kind} after stop dropped latin={latin_name} intent={intent}")
+        return self._stopped
+
+    def _full(self, kind: str, key: tuple[str, str], buffer) -> bool:
+        # БД недоступна долго — не растим буфер без предела; уже известные ключи
+        # обновляются на месте и места не занимают
+        if key in buffer or len(self) < self.max_pending:
+            return False
+        error("write_overflow")
+        if not self._overflowed:
+            self._overflowed = True
+            logger.error(f"[WRITE] buffer full ({self.max_pending}), dropping new {kind} writes")
+        return True
+
+    def _kick(self) -> None:
+        if self._task is None:
+            self.start()
+        if len(self) >= self.max_batch and not self._failures:
+            self._wake.set()
+
+    # --- Жизненный цикл
+    def start(self) -> None:
+        self._stopped = False
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает фоновый цикл и сбрасывает всё, что осталось в буфере.
+
+        Идущий сброс дожидается, а не отменяется; новые записи после stop()
+        отбрасываются с ошибкой в лог (до следующего start()).
+        """
+        self._stopped = True
+        task, self._task = self._task, None
+        if task is not None:
+            self._wake.set()
+            await task
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"[WRITE] final flush failed, {len(self)} pending writes lost: {e}")
+
+    async def _run(self) -> None:
+        while not self._stopped:
+            # после неудачных сбросов — пауза 2^n * interval, но не дольше MAX_BACKOFF_SECONDS;
+            # MAX_BATCH в это время не будит цикл, stop() — будит
+            delay = min(self.interval * 2 ** self._failures, MAX_BACKOFF_SECONDS)
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # буфер уже возвращён во flush — повторим в следующий раз
+                logger.warning(f"[WRITE] flush failed, will retry: {e}")
+
+    async def flush(self) -> int:
+        """Сбрасывает буфер; возвращает число записанных записей."""
+        async with self._flush_lock:
+            if not len(self):
+                return 0
+            items = [("card", key, value) for key, value in self._cards.items()]
+            items += [("hits", key, n) for key, n in self._hits.items()]
+            self._cards, self._hits = {}, Counter()
+            # очередь кусков: целиком, при ошибке данных — половинки
+            queue = deque([items])
+            written = dropped = 0
+            try:
+                with stage("write_flush"):
+                    while queue:
+                        chunk = queue[0]
+                        try:
+                            await self._write(chunk)
+                        except Exception as e:
+                            if not _is_data_error(e):
+                                raise
+                            queue.popleft()
+                            if len(chunk) == 1:
+                                dropped += 1
+                                self._drop(chunk[0], e)
+                            else:
+                                mid = len(chunk) // 2
+                                queue.extendleft((chunk[mid:], chunk[:mid]))
+                            continue
+                        queue.popleft()
+                        written += len(chunk)
+                        for kind, key, _ in chunk:
+                            self._attempts.pop((kind, key), None)
+            except BaseException:  # в т.ч. CancelledError посреди сброса
+                error("write_flush")
+                self._failures += 1
+                self._restore([item for chunk in queue for item in chunk])
+                raise
+            self._failures = 0
+            self._overflowed = False
+            logger.info(f"[WRITE] flushed {written} writes, dropped {dropped}")
+            return written
+
+    async def _write(self, chunk: list[tuple]) -> None:
+        cards = [(latin, intent, *value) for kind, (latin, intent), value in chunk if kind == "card"]
+        hits = [(latin, intent, n) for kind, (latin, intent), n in chunk if kind == "hits"]
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # сначала карточки — hits обновляют уже существующие строки
+                if cards:
+                    await conn.executemany(UPSERT_CARD_SQL, cards)
+                if hits:
+                    await conn.executemany(INCREMENT_HITS_SQL, hits)
+
+    def _drop(self, item: tuple, reason) -> None:
+        kind, (latin, intent), _ = item
+        self._attempts.pop((kind, (latin, intent)), None)
+        error("write_flush")
+        logger.error(f"[WRITE] dropped {kind} latin={latin} intent={intent}: {reason}")
+
+    def _restore(self, items: list[tuple]) -> None:
+        # вернуть в буфер, не затирая более свежие версии карточек
+        for item in items:
+            kind, key, value = item
+            self._attempts[(kind, key)] += 1
+            if self._attempts[(kind, key)] >= self.max_retries:
+                self._drop(item, f"{self.max_retries} failed flushes")
+            elif kind == "card":
+                self._cards.setdefault(key, value)
+            else:
+                self._hits[key] += value
+
+writer = WriteBehind()